@@ -0,0 +1,367 @@
+"""
+Offline benchmarks of the hot paths on a synthetic ISBN dump.
+
+The synthetic dump (see synthetic.py) is written under the real file name
+into a work directory, so the tools find it exactly where they look for the
+real one. Every scenario runs in a fresh process: its setup (loading the
+store, building a database) is not timed, its body is, and the process'
+peak RSS is reported alongside. Results are printed, and written with
+--output, as JSON.
+
+Usage:
+    python run.py                                  # all scenarios at density 0.01
+    python run.py --density 0.1 --only point_lookup,tile --output report.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+import synthetic
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+TOOLS_DIR = REPO_DIR / "tools"
+INPUT_FILENAME = "aa_isbn13_codes_20241204T185335Z.benc.zst"  # data_loader.INPUT_FILENAME
+START_ISBN = 978000000000
+RARE_ROWS = 200000  # Synthetic rows of rare_books.db, see rare_books/db.synthetic_rows
+PYRAMID_SCALES = (5, 25, 50)  # 1:1 adds 2500 PNG tiles; pass --pyramid-scales 1 5 25 50 for the full set
+
+SCENARIOS = {}
+
+
+def scenario(name):
+    """Register `function(args)`, which does its setup and returns (timed body, unit) where body() returns ops."""
+    def register(function):
+        SCENARIOS[name] = function
+        return function
+    return register
+
+
+def random_isbns(bm, n, rng):
+    """`n` ISBN-13s as strings, half of them taken from the dataset and half anywhere on the map."""
+    present = [str(bm.isbn_at(int(rank))) for rank in rng.integers(0, len(bm), n // 2)]
+    anywhere = [f"{START_ISBN + int(position)}0" for position in rng.integers(0, synthetic.SPAN, n - n // 2)]
+    return present + anywhere
+
+
+@scenario("store_convert")
+def store_convert(args):
+    """The .benc.zst to memory-mapped store conversion (data_loader.convert_to_store), not the WorldCat ingest."""
+    import data_loader as D
+    shutil.rmtree(D.STORE_DIR, ignore_errors=True)
+
+    def body():
+        manifest = D.convert_to_store(INPUT_FILENAME, D.STORE_DIR)
+        return sum(entry["runs"] for entry in manifest["datasets"].values())
+    return body, "runs"
+
+
+@scenario("point_lookup")
+def point_lookup(args):
+    import data_loader as D
+    bm = D.load_bitmap_manager(INPUT_FILENAME, START_ISBN, "gbooks")
+    isbns = random_isbns(bm, 100000, np.random.default_rng(0))
+
+    def body():
+        for isbn in isbns:
+            bm.is_available(isbn)
+        return len(isbns)
+    return body, "lookups"
+
+
+@scenario("batch_lookup")
+def batch_lookup(args):
+    import data_loader as D
+    registry = D.load_bitmap_registry(INPUT_FILENAME, START_ISBN)
+    isbns = np.array(random_isbns(registry.get(), 1000000, np.random.default_rng(0)), dtype=np.int64)
+
+    def body():
+        registry.sources_many(isbns)
+        return len(isbns)
+    return body, "lookups"
+
+
+@scenario("detail_window")
+def detail_window(args):
+    import data_loader as D
+    bm = D.load_bitmap_manager(INPUT_FILENAME, START_ISBN, "gbooks")
+    isbns = random_isbns(bm, 10000, np.random.default_rng(0))
+
+    def body():
+        for isbn in isbns:
+            bm.check_isbns_from(isbn, 100)
+        return len(isbns)
+    return body, "windows"
+
+
+@scenario("cluster_window")
+def cluster_window(args):
+    import data_loader as D
+    bm = D.load_bitmap_manager(INPUT_FILENAME, START_ISBN, "gbooks")
+    positions = np.random.default_rng(0).integers(0, synthetic.SPAN - 800000, 200).tolist()
+
+    def body():
+        for position in positions:
+            bm.check_window(position, n=800000)
+        return len(positions)
+    return body, "windows"
+
+
+@scenario("global_view")
+def global_view(args):
+    import data_loader as D
+    bm = D.load_bitmap_manager(INPUT_FILENAME, START_ISBN, "gbooks")
+
+    def body():
+        for _ in range(10):
+            bm.generate_global_view(1000, 800, 50)
+        return 10
+    return body, "views"
+
+
+@scenario("tile")
+def tile(args):
+    import data_loader as D
+    bm = D.load_bitmap_manager(INPUT_FILENAME, START_ISBN, "gbooks")
+    tiles = np.random.default_rng(0).integers(0, 50, (200, 2)).tolist()
+
+    def body():
+        for tile_x, tile_y in tiles:
+            bm.tile(tile_x, tile_y)
+        return len(tiles)
+    return body, "tiles"
+
+
+@scenario("global_tile")
+def global_tile(args):
+    # The first tile decodes the 1:1 layers of all datasets, later ones only slice them
+    import generate
+    tiles = np.random.default_rng(0).integers(0, 50, (20, 2)).tolist()
+
+    def body():
+        for tile_x, tile_y in tiles:
+            generate.generate_global_tile(tile_x, tile_y, 1000, 800, "global_tiles")
+        return len(tiles)
+    return body, "tiles"
+
+
+@scenario("density_layer")
+def density_layer(args):
+    """annaimages.density_layer at 1:50 per dataset, which paints through annaimages.color_image."""
+    import annaimages
+
+    def body():
+        for runs in annaimages.isbn_data.values():
+            annaimages.density_layer(runs, 50)
+        return len(annaimages.isbn_data)
+    return body, "layers"
+
+
+@scenario("density_pyramid")
+def density_pyramid(args):
+    import data_loader as D
+    from density import DensityPyramid
+    isbn_data = D.load_isbn_data(INPUT_FILENAME)
+
+    def body():
+        for runs in isbn_data.values():
+            DensityPyramid.build(runs)
+        return len(isbn_data)
+    return body, "datasets"
+
+
+@scenario("tile_pyramid")
+def tile_pyramid(args):
+    import build_pyramid
+    shutil.rmtree("pyramid", ignore_errors=True)
+    shutil.rmtree("pyramid_layers", ignore_errors=True)
+
+    def body():
+        build_pyramid.build_pyramid(INPUT_FILENAME, "pyramid", "pyramid_layers", tuple(args.pyramid_scales), args.workers)
+        with open(os.path.join("pyramid", "manifest.json"), "r") as f:
+            return len(json.load(f)["tiles"])
+    return body, "tiles"
+
+
+@scenario("stats")
+def dataset_stats(args):
+    import data_loader as D
+    import stats
+    isbn_data = D.load_isbn_data(INPUT_FILENAME)
+
+    def body():
+        stats.compute_stats(isbn_data)
+        return len(isbn_data)
+    return body, "datasets"
+
+
+def rare_books_db():
+    """Fill rare_books.db (in the current directory) with synthetic rows once; setup, not timed."""
+    import db
+    if not os.path.exists(db.DB_FILE):
+        conn = db.connect()
+        db.setup_schema(conn)
+        with db.bulk_load(conn):
+            for batch in db.synthetic_rows(RARE_ROWS):
+                db.upsert_amended(conn, batch)
+                conn.commit()
+        conn.close()
+    return db.DB_FILE
+
+
+@scenario("rare_export")
+def rare_export(args):
+    import sort_tile
+    conn = sqlite3.connect(rare_books_db())
+    records = conn.execute("SELECT COUNT(*) FROM oclc_holdings WHERE isbn_13 IS NOT NULL AND total_holding_count < ?",
+                           (sort_tile.RARE_THRESHOLD,)).fetchone()[0]
+    conn.close()
+    shutil.rmtree(sort_tile.OUTPUT_DIR, ignore_errors=True)
+
+    def body():
+        sort_tile.fetch_isbns_in_batches()
+        return records
+    return body, "records"
+
+
+@scenario("rare_existence")
+def rare_existence(args):
+    import sort_tile
+    rare_books_db()
+    if not os.path.exists(sort_tile.OUTPUT_DIR):
+        sort_tile.fetch_isbns_in_batches()
+    sort_tile.ISBN_CODES_FILE = os.path.join("..", INPUT_FILENAME)
+    sort_tile.ISBN_STORE_DIR = os.path.join("..", "isbn_store")
+
+    def body():
+        sort_tile.existence_check(sort_tile.OUTPUT_DIR)
+        return len(list(Path(sort_tile.OUTPUT_DIR).glob("tile_*.json")))
+    return body, "tiles"
+
+
+@scenario("rare_viewport")
+def rare_viewport(args):
+    from rare_index import RarebookIndex
+    index = RarebookIndex.from_db(rare_books_db())
+    rng = np.random.default_rng(0)
+    corners = zip(rng.integers(0, 47000, 1000).tolist(), rng.integers(0, 37600, 1000).tolist())
+
+    def body():
+        for x0, y0 in corners:
+            index.records(index.query(x0, y0, x0 + 3000, y0 + 2400)[0])
+        return 1000
+    return body, "queries"
+
+
+@scenario("rare_search")
+def rare_search(args):
+    from rare_index import search_titles
+    db_file = rare_books_db()
+    queries = [str(k) for k in np.random.default_rng(0).integers(1, 1000, 1000).tolist()]
+
+    def body():
+        for query in queries:
+            search_titles(db_file, query)
+        return len(queries)
+    return body, "queries"
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is in KB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_scenario(name, args):
+    """Run one scenario in this process and return its result."""
+    sys.path[:0] = [str(TOOLS_DIR), str(TOOLS_DIR / "rare_books")]
+    # The rare-book tools keep their database and tiles in the current directory
+    if name.startswith("rare_"):
+        os.makedirs("rare_books", exist_ok=True)
+        os.chdir("rare_books")
+
+    body, unit = SCENARIOS[name](args)
+    started = time.perf_counter()
+    ops = body()
+    seconds = time.perf_counter() - started
+    return {
+        "scenario": name,
+        "ops": ops,
+        "unit": unit,
+        "seconds": round(seconds, 4),
+        "ops_per_sec": round(ops / seconds, 2) if seconds else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ISBN map tools on synthetic data.")
+    parser.add_argument("--density", type=float, default=0.01, help="dataset sizes relative to the real dump")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", help="comma-separated scenarios, default all: " + ",".join(SCENARIOS))
+    parser.add_argument("--workdir", help="keep the synthetic data here instead of a temporary directory")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    parser.add_argument("--pyramid-scales", type=int, nargs="+", default=list(PYRAMID_SCALES))
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)  # Child process: run one scenario in the workdir
+    args = parser.parse_args()
+
+    if args.scenario:
+        os.chdir(args.workdir)
+        # The tools' progress prints go to stderr, stdout carries only the result
+        with contextlib.redirect_stdout(sys.stderr):
+            result = run_scenario(args.scenario, args)
+        print(json.dumps(result))
+        return
+
+    names = args.only.split(",") if args.only else list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bookuniverse-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    started = time.perf_counter()
+    synthetic.write_benc_zst(synthetic.synthetic_datasets(args.density, args.seed), os.path.join(workdir, INPUT_FILENAME))
+    print(f"Synthetic dump written to {workdir} in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    results = []
+    for name in names:
+        command = [sys.executable, os.path.abspath(__file__), "--scenario", name, "--workdir", os.path.abspath(workdir),
+                   "--workers", str(args.workers), "--pyramid-scales", *map(str, args.pyramid_scales)]
+        completed = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+        if completed.returncode != 0:
+            results.append({"scenario": name, "error": f"exit status {completed.returncode}"})
+        else:
+            results.append(json.loads(completed.stdout))
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    report = {
+        "density": args.density,
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpus": os.cpu_count(),
+        "scenarios": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Synthetic ISBN datasets in the layout of Anna's Archive aa_isbn13_codes dump.
+
+Every dataset is a little-endian uint32 array alternating `isbn_streak` and
+`gap_size` from ISBN 978000000000, sized after the real dump (see
+tools/datasets.json) times `density`. Streaks are short, most gaps are short
+too (ISBNs assigned within a publisher block), and a few heavy-tailed gaps
+spread the blocks over the whole 978/979 range, which is what the streak
+index and the tile renderers see in the real data.
+
+Usage:
+    python synthetic.py --density 0.01 --output aa_isbn13_codes_synthetic.benc.zst
+"""
+import argparse
+import json
+from pathlib import Path
+
+import bencodepy
+import numpy as np
+import zstandard
+
+DATASETS_FILE = Path(__file__).resolve().parent.parent / "tools" / "datasets.json"
+SPAN = 50000 * 40000  # Positions of the map, 978000000000 to 979999999999
+MEAN_STREAK = 3.0  # ISBNs per streak
+MEAN_SHORT_GAP = 12.0  # Positions between streaks of one publisher block
+LONG_GAP_SHARE = 0.02  # Share of gaps that jump to another block
+
+
+def dataset_sizes(density=0.01, datasets_file=DATASETS_FILE):
+    """ISBN count of every dataset of the real dump, scaled by `density`."""
+    with open(datasets_file, "r") as f:
+        sizes = json.load(f)
+    return {name: max(1, round(count * density)) for name, count in sizes.items()}
+
+
+def synthetic_runs(count, rng, span=SPAN):
+    """
+    Run array of about `count` ISBNs spread over `span` positions: an empty
+    first streak, then streaks and gaps, ending with a streak.
+    """
+    n = max(1, round(count / MEAN_STREAK))
+    streaks = rng.geometric(1 / MEAN_STREAK, n).astype(np.int64)
+    gaps = rng.geometric(1 / MEAN_SHORT_GAP, n).astype(np.int64)
+
+    # The first gap and a few others are long; they share what is left of the span
+    long = rng.random(n) < LONG_GAP_SHARE
+    long[0] = True
+    weights = rng.lognormal(0.0, 1.5, int(long.sum()))
+    budget = max(span - int(streaks.sum()) - int(gaps[~long].sum()), 0)
+    gaps[long] = np.floor(weights * (budget / weights.sum())).astype(np.int64)
+
+    runs = np.empty(2 * n, dtype="<u4")
+    runs[0] = 0
+    runs[1::2] = gaps
+    runs[2::2] = streaks[:-1]
+    return np.append(runs, np.uint32(streaks[-1])).astype("<u4")
+
+
+def synthetic_datasets(density=0.01, seed=0):
+    """Run arrays of all datasets of the dump by name."""
+    rng = np.random.default_rng(seed)
+    return {name: synthetic_runs(count, rng) for name, count in sorted(dataset_sizes(density).items())}
+
+
+def write_benc_zst(datasets, output_file):
+    """Write run arrays as a bencoded, zstd-compressed dict, like the aa_isbn13_codes dump."""
+    payload = bencodepy.encode({name.encode(): runs.tobytes() for name, runs in datasets.items()})
+    with open(output_file, "wb") as f:
+        f.write(zstandard.ZstdCompressor(level=3).compress(payload))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic aa_isbn13_codes .benc.zst file.")
+    parser.add_argument("--density", type=float, default=0.01, help="dataset sizes relative to the real dump")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="aa_isbn13_codes_synthetic.benc.zst")
+    args = parser.parse_args()
+
+    datasets = synthetic_datasets(args.density, args.seed)
+    write_benc_zst(datasets, args.output)
+    for name, runs in datasets.items():
+        print(f"{name}: {int(runs[0::2].sum(dtype=np.int64))} ISBNs in {len(runs)} runs")
+
+
+if __name__ == "__main__":
+    main()
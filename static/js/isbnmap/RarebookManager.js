@@ -5,35 +5,92 @@ export class RarebookManager {
         this.tileWidth = tileWidth;
         this.tileHeight = tileHeight;
         this.cache = new Map();
+        this.binary = true; // switched off after the first missing .bin tile, then JSON only
     }
 
     async loadTile(x, y) {
         if (this.cache.has(`${x}_${y}`)) {
             return this.cache.get(`${x}_${y}`);
         }
-        
-        const filePath = `${this.tilePath}tile_${x}_${y}.json`;
+
         try {
-            const response = await fetch(filePath);
-            const data = await response.json();
+            const data = (this.binary && await this.loadBinaryTile(x, y)) || await this.loadJsonTile(x, y);
             this.cache.set(`${x}_${y}`, data);
-            if (Array.isArray(data)) {
-                //console.log(`Tile (0,2) contains ${data.length} books.`);
-                data.forEach(book => {
-                    if (!book.i || !book.t || !book.h) {
-                        console.warn(`Invalid book entry:`, book);
-                    }
-                });
-            } else {
-                console.error(`Unexpected data format for tile (0,2):`, data);
-            }
-                                return data;
+            return data;
         } catch (error) {
             console.error(`Failed to load tile (${x}, ${y}):`, error);
             return null;
         }
     }
 
+    // Binary columnar tile (see sort_tile.encode_tile); books come sorted by (y, x)
+    async loadBinaryTile(x, y) {
+        const response = await fetch(`${this.tilePath}tile_${x}_${y}.bin`);
+        if (!response.ok) {
+            this.binary = false;
+            return null;
+        }
+        const buffer = await response.arrayBuffer();
+        const view = new DataView(buffer);
+        if (view.getUint32(0) !== 0x52425431) { // "RBT1"
+            this.binary = false;
+            return null;
+        }
+        const count = view.getUint32(4, true);
+        const titleBytes = view.getUint32(8, true);
+
+        let offset = 16;
+        const deltas = new BigUint64Array(buffer, offset, count);
+        offset += 8 * count;
+        const titleOffsets = new Uint32Array(buffer, offset, count + 1);
+        offset += 4 * (count + 1);
+        const xs = new Uint16Array(buffer, offset, count);
+        offset += 2 * count;
+        const ys = new Uint16Array(buffer, offset, count);
+        offset += 2 * count;
+        const holdings = new Uint8Array(buffer, offset, count);
+        offset += count;
+        const existence = new Uint8Array(buffer, offset, count);
+        offset += count;
+        const titles = new Uint8Array(buffer, offset, titleBytes);
+
+        const decoder = new TextDecoder();
+        const books = new Array(count);
+        let isbn = 0;
+        for (let k = 0; k < count; k++) {
+            isbn += Number(deltas[k]);
+            books[k] = {
+                i: isbn,
+                t: decoder.decode(titles.subarray(titleOffsets[k], titleOffsets[k + 1])),
+                h: holdings[k],
+                e: existence[k],
+                x: x * this.tileWidth + xs[k],
+                y: y * this.tileHeight + ys[k],
+            };
+        }
+        return books;
+    }
+
+    async loadJsonTile(x, y) {
+        const response = await fetch(`${this.tilePath}tile_${x}_${y}.json`);
+        const data = await response.json();
+        if (!Array.isArray(data)) {
+            console.error(`Unexpected data format for tile (${x},${y}):`, data);
+            return null;
+        }
+        data.forEach(book => {
+            if (!book.i || !book.t || !book.h) {
+                console.warn(`Invalid book entry:`, book);
+            }
+            // Positions are computed once here rather than on every view change
+            book.x = (Math.floor(book.i/10) - 978000000000) % 50000;
+            book.y = Math.floor((Math.floor(book.i/10) - 978000000000) / 50000);
+        });
+        // Tiles are exported in ISBN order, i.e. sorted by (y, x), but make sure of it
+        data.sort((a, b) => a.y - b.y || a.x - b.x);
+        return data;
+    }
+
     async loadVisibleTiles(offsetX, offsetY, viewWidth = 1000, viewHeight = 800) {
         const startX = Math.floor(offsetX / this.tileWidth);
         const startY = Math.floor(offsetY / this.tileHeight);
@@ -48,7 +105,7 @@ export class RarebookManager {
                 }
             }
         }
-    
+
         await Promise.all(promises);
     }
 
@@ -62,7 +119,7 @@ export class RarebookManager {
         for (let x = startX; x <= endX; x++) {
             for (let y = startY; y <= endY; y++) {
                 const key = `${x}_${y}`;
-                if (this.cache.has(key)) {
+                if (this.cache.has(key) && this.cache.get(key)) {
                     const tileData = this.cache.get(key);
                     booksInView = booksInView.concat(this.filterBooksByView(tileData, offsetX, offsetY, viewWidth, viewHeight));
                 }
@@ -71,13 +128,29 @@ export class RarebookManager {
         return booksInView;
     }
 
-    filterBooksByView(tileData, offsetX, offsetY, viewWidth, viewHeight) {
-        return tileData.filter(book => {
-            // we only need a small range  of isbn to be visible within the viewport
-            book.x = (Math.floor(book.i/10) - 978000000000) % 50000;
-            book.y = Math.floor((book.i/10- 978000000000) / 50000);
+    // First index whose y is >= minY; tile books are sorted by (y, x)
+    lowerBound(tileData, minY) {
+        let low = 0, high = tileData.length;
+        while (low < high) {
+            const mid = (low + high) >> 1;
+            if (tileData[mid].y < minY) {
+                low = mid + 1;
+            } else {
+                high = mid;
+            }
+        }
+        return low;
+    }
 
-            return book.x >= offsetX && book.x <= offsetX + viewWidth && book.y >= offsetY && book.y <= offsetY + viewHeight;
-        });
+    filterBooksByView(tileData, offsetX, offsetY, viewWidth, viewHeight) {
+        // we only need a small range of isbn to be visible within the viewport: scan the visible rows only
+        const books = [];
+        for (let k = this.lowerBound(tileData, offsetY); k < tileData.length && tileData[k].y <= offsetY + viewHeight; k++) {
+            const book = tileData[k];
+            if (book.x >= offsetX && book.x <= offsetX + viewWidth) {
+                books.push(book);
+            }
+        }
+        return books;
     }
-}
\ No newline at end of file
+}
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "tools"), ROOT]  # app.py imports both `tools.data_loader` and flat modules
+sys.path.append(os.path.join(ROOT, "tools", "rare_books"))  # sort_tile and db are flat modules of their own directory
+
+
+@pytest.fixture
+def client(monkeypatch):
+    import app as webapp
+    from bitmap_manager import BitmapRegistry
+
+    # gbooks holds ISBN-13s 9780000000101 to 9780000000149 (positions 10 to 14), md5 the first two of them
+    datasets = {"gbooks": np.array([0, 10, 5], dtype="<u4"), "md5": np.array([0, 10, 2], dtype="<u4")}
+    monkeypatch.setattr(webapp, "registry", BitmapRegistry(datasets, webapp.START_ISBN))
+    return webapp.app.test_client()
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from density import GRID_WIDTH, DensityPyramid, block_counts, edge_block_counts, streak_block_counts
+from isbn_runs import streak_bounds
+
+ROWS = 200  # Rows of the 1:1 map holding the test data
+
+
+@pytest.fixture(scope="module")
+def data():
+    # Streaks from a few positions to over two rows long, some crossing row ends
+    rng = np.random.default_rng(0)
+    runs = [0]
+    while sum(runs) < (ROWS - 5) * GRID_WIDTH:
+        runs += [int(rng.integers(1, 60000)), int(rng.choice([rng.integers(1, 50), rng.integers(1, 120000)]))]
+    runs = np.array(runs, dtype="<u4")
+    starts, ends = streak_bounds(runs)
+    grid = np.zeros(ROWS * GRID_WIDTH, dtype=np.int64)
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        grid[start:end] = 1
+    return runs, starts, ends, grid.reshape(ROWS, GRID_WIDTH)
+
+
+def naive_blocks(grid, scale, x0, y0, x1, y1):
+    block = grid[y0 * scale:y1 * scale, x0 * scale:x1 * scale]
+    return block.reshape(y1 - y0, scale, x1 - x0, scale).sum(axis=(1, 3))
+
+
+@pytest.mark.parametrize("scale, viewport", [
+    (1, (0, 0, 700, 5)), (1, (49990, 3, 50000, 9)), (5, (0, 0, 10000, 40)),
+    (5, (123, 7, 457, 31)), (10, (4990, 0, 5000, 20)), (25, (0, 0, 2000, 8)), (50, (17, 1, 93, 4)),
+])
+def test_both_methods_match_the_naive_block_sums(data, scale, viewport):
+    _, starts, ends, grid = data
+    expected = naive_blocks(grid, scale, *viewport)
+    assert np.array_equal(edge_block_counts(starts, ends, scale, *viewport), expected)
+    assert np.array_equal(streak_block_counts(starts, ends, scale, *viewport), expected)
+    assert np.array_equal(block_counts(starts, ends, scale, *viewport), expected)
+
+
+def test_block_counts_clips_to_the_grid(data):
+    _, starts, ends, _ = data
+    assert block_counts(starts, ends, 50, 990, 798, 1200, 900).shape == (2, 10)
+    assert block_counts(starts, ends, 50, 10, 10, 5, 20).shape == (10, 0)
+
+
+def test_levels_are_zooms_of_each_other(data):
+    runs, starts, ends, grid = data
+    pyramid = DensityPyramid.build(runs, scales=(10, 25, 50, 100))
+    for scale in (10, 25, 50, 100):
+        assert pyramid.levels[scale].shape == DensityPyramid.shape(scale)
+        assert np.array_equal(pyramid.query(scale, 0, 0, GRID_WIDTH // scale, ROWS // scale),
+                              naive_blocks(grid, scale, 0, 0, GRID_WIDTH // scale, ROWS // scale))
+    assert int(pyramid.levels[100].sum(dtype=np.int64)) == int(grid.sum())
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from interval_sets import IntervalSet, OPERATIONS
+
+CASES = [
+    ([(0, 5), (10, 20)], [(5, 10)]),  # Adjacent: touching ends, no overlap
+    ([(0, 5), (5, 8)], [(3, 6), (8, 9)]),  # Adjacent intervals inside one operand
+    ([(2, 2), (4, 7)], [(4, 4), (6, 9)]),  # Empty intervals
+    ([], [(1, 4)]),
+    ([(1, 4)], []),
+    ([], []),
+    ([(0, 100)], [(0, 100)]),
+    ([(0, 3), (7, 12), (20, 25)], [(2, 8), (11, 21), (24, 30)]),
+]
+
+
+def interval_set(intervals):
+    return IntervalSet([start for start, _ in intervals], [end for _, end in intervals])
+
+
+def positions(intervals):
+    return {position for start, end in intervals for position in range(start, end)}
+
+
+def members(result):
+    return [position for chunk in result.iter_positions(chunk_size=3) for position in chunk.tolist()]
+
+
+NAIVE = {"union": set.union, "intersection": set.intersection, "difference": set.difference}
+
+
+@pytest.mark.parametrize("operation", sorted(OPERATIONS))
+@pytest.mark.parametrize("first, second", CASES)
+def test_matches_naive_sets(operation, first, second):
+    result = OPERATIONS[operation](interval_set(first), interval_set(second))
+    expected = NAIVE[operation](positions(first), positions(second))
+    assert members(result) == sorted(expected)
+    assert result.cardinality() == len(expected)
+    # Sorted, disjoint and non-empty, with adjacent pieces merged
+    assert np.all(result.starts < result.ends)
+    assert np.all(result.ends[:-1] < result.starts[1:])
+
+
+@pytest.mark.parametrize("operation", sorted(OPERATIONS))
+def test_random_sets(operation):
+    rng = np.random.default_rng(0)
+    operands = []
+    for _ in range(3):
+        bounds = np.sort(rng.choice(2000, size=80, replace=False))
+        operands.append(list(zip(bounds[::2].tolist(), bounds[1::2].tolist())))
+    result = OPERATIONS[operation](*map(interval_set, operands))
+    assert members(result) == sorted(NAIVE[operation](*map(positions, operands)))
+
+
+def test_operators():
+    a, b = interval_set([(0, 5)]), interval_set([(3, 8)])
+    assert members(a | b) == list(range(8))
+    assert members(a & b) == [3, 4]
+    assert members(a - b) == [0, 1, 2]
+    assert len(interval_set([])) == 0
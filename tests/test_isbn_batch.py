@@ -0,0 +1,35 @@
+def test_text_body_with_bom_and_non_ascii_line(client):
+    body = "\ufeff9780000000101\n978000000010\u00e9\n0000000108\n".encode("utf-8")
+    response = client.post("/api/isbn/batch", data=body, content_type="text/plain")
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result["isbns"] == ["9780000000101", None, "9780000000101"]
+    assert result["masks"] == [3, 0, 3]
+
+
+def test_invalid_utf8_is_null(client):
+    response = client.post("/api/isbn/batch", data=b"\xff\xfe\n9780000000101\n", content_type="text/plain")
+    assert response.status_code == 200
+    assert response.get_json()["isbns"] == [None, "9780000000101"]
+
+
+def test_json_list_with_non_ascii_value(client):
+    response = client.post("/api/isbn/batch", json=["9780000000101", "\uff19\uff17\uff18" + "0000000101"])
+    assert response.status_code == 200
+    assert response.get_json()["isbns"] == ["9780000000101", None]
+
+
+def test_sources_accepts_isbn10_and_rejects_invalid(client):
+    response = client.get("/api/isbn/0-00-000010-8/sources")
+    assert response.status_code == 200
+    assert response.get_json()["isbn"] == "9780000000101"
+    assert response.get_json()["sources"] == ["gbooks", "md5"]
+    assert client.get("/api/isbn/97800000001x1/sources").status_code == 400
+    assert client.get("/api/isbn/9780000000102/sources").status_code == 400
+
+
+def test_single_lookup_validates_the_isbn(client):
+    assert client.get("/api/isbn/978-0-00-000010-1").get_json() == {"status": "available"}
+    assert client.get("/api/isbn/0000000108").get_json() == {"status": "available"}
+    assert client.get("/api/isbn/9780000000156").get_json() == {"status": "unavailable"}
+    assert client.get("/api/isbn/abc").status_code == 400
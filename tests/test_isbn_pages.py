@@ -0,0 +1,23 @@
+import pytest
+
+
+@pytest.mark.parametrize("url", ["/api/isbns?limit=0", "/api/isbns?limit=-1",
+                                 "/api/sets/union?datasets=gbooks,md5&list=1&limit=0"])
+def test_non_positive_limit_is_rejected(client, url):
+    assert client.get(url).status_code == 400
+
+
+def test_next_cursor_resumes_after_the_page(client):
+    response = client.get("/api/isbns?limit=2")
+    assert response.get_data(as_text=True) == '"9780000000101"\n"9780000000118"\n'
+    assert response.headers["X-Next-Cursor"] == "9780000000118"
+
+    response = client.get("/api/isbns?limit=5&cursor=" + response.headers["X-Next-Cursor"])
+    assert response.get_data(as_text=True) == '"9780000000125"\n"9780000000132"\n"9780000000149"\n'
+    assert "X-Next-Cursor" not in response.headers
+
+
+def test_empty_set_listing_has_empty_body(client):
+    response = client.get("/api/sets/difference?datasets=md5,gbooks&list=1")
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == ""
@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+import db
+import sort_tile
+from isbn_runs import isbn13_numbers
+
+MAX_ISBN_13 = int(isbn13_numbers(sort_tile.BASE_ISBN + sort_tile.TOTAL_WIDTH * sort_tile.TOTAL_HEIGHT - 1))
+MAX_OCLC_NUMBER = str(2 ** 64 - 1)
+
+
+def isbn_at(x, y):
+    return int(isbn13_numbers(sort_tile.BASE_ISBN + y * sort_tile.TOTAL_WIDTH + x))
+
+
+def test_round_trip():
+    records = [
+        {"i": isbn_at(1999, 1599), "t": "Vocabolario — ñ", "h": 3, "e": 1},
+        {"i": isbn_at(1000, 800), "t": "", "h": 1},
+        {"i": isbn_at(1000, 800) + 10, "t": None, "h": 2, "e": 0},
+    ]
+    decoded = sort_tile.decode_tile(sort_tile.encode_tile(records, 1, 1))
+    assert decoded == [
+        {"i": isbn_at(1000, 800), "t": "", "h": 1, "e": 0, "x": 0, "y": 0},
+        {"i": isbn_at(1000, 800) + 10, "t": "", "h": 2, "e": 0, "x": 1, "y": 0},
+        {"i": isbn_at(1999, 1599), "t": "Vocabolario — ñ", "h": 3, "e": 1, "x": 999, "y": 799},
+    ]
+
+
+def test_round_trip_extremes():
+    assert sort_tile.decode_tile(sort_tile.encode_tile([], 0, 0)) == []
+    last_x, last_y = sort_tile.calculate_tile_position(MAX_ISBN_13)
+    record = {"i": MAX_ISBN_13, "t": "last", "h": 255, "e": 255}
+    decoded = sort_tile.decode_tile(sort_tile.encode_tile([record], last_x, last_y))
+    assert decoded == [dict(record, x=sort_tile.TILE_WIDTH - 1, y=sort_tile.TILE_HEIGHT - 1)]
+
+
+def test_rejects_other_data():
+    with pytest.raises(ValueError):
+        sort_tile.decode_tile(b"[]")
+
+
+def test_export_matches_json_tiles(tmp_path, monkeypatch):
+    # A first band, an empty middle band, the last map cell and the largest OCLC number
+    rows = [
+        (MAX_OCLC_NUMBER, 1, isbn_at(5, 0), "first"),
+        ("7", 2, isbn_at(5, 0), "same isbn"),
+        ("8", 9, isbn_at(6, 0), "not rare"),
+        ("9", 3, isbn_at(12345, 30), "second tile"),
+        ("10", 1, MAX_ISBN_13, "last"),
+    ]
+    monkeypatch.setattr(sort_tile, "DB_FILE", str(tmp_path / "rare.db"))
+    monkeypatch.setattr(sort_tile, "OUTPUT_DIR", str(tmp_path / "tiles"))
+    monkeypatch.setattr(sort_tile, "BATCH_SIZE", 2)
+    conn = db.connect(sort_tile.DB_FILE)
+    db.setup_schema(conn)
+    conn.executemany(
+        "INSERT INTO oclc_holdings (oclc_number, total_holding_count, isbn_13, title) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+    sort_tile.fetch_isbns_in_batches()
+
+    tiles = tmp_path / "tiles"
+    assert len(list(tiles.glob("*.bin"))) == (sort_tile.TOTAL_WIDTH // sort_tile.TILE_WIDTH) * (
+        sort_tile.TOTAL_HEIGHT // sort_tile.TILE_HEIGHT)
+    for tile_file in tiles.glob("*.json"):
+        records = json.loads(tile_file.read_text())
+        decoded = sort_tile.decode_tile(tile_file.with_suffix(".bin").read_bytes())
+        assert [{key: record[key] for key in ("i", "t", "h")} for record in decoded] == records
+    # Records sharing an ISBN keep the text order of oclc_number
+    assert [record["t"] for record in json.loads((tiles / "tile_0_0.json").read_text())] == ["first", "same isbn"]
+    assert json.loads((tiles / "tile_12_0.json").read_text())[0]["t"] == "second tile"
+    assert json.loads((tiles / "tile_0_1.json").read_text()) == []  # Empty band
+    last = sort_tile.decode_tile((tiles / "tile_49_49.bin").read_bytes())
+    assert [(record["i"], record["x"], record["y"]) for record in last] == [(MAX_ISBN_13, 999, 799)]
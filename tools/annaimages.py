@@ -1,54 +1,67 @@
-import bencodepy
 import PIL.Image
-import PIL.ImageChops
-import struct
-import tqdm
-import zstandard
-import os
+import numpy as np
 import json
 
+import data_loader as D
+from density import bucket_counts
+from isbn_runs import decode_runs, streak_bounds
+import stats
+
 # Get the latest from the `codes_benc` directory in `aa_derived_mirror_metadata`:
 # https://annas-archive.org/torrents#aa_derived_mirror_metadata
 input_filename = 'aa_isbn13_codes_20241204T185335Z.benc.zst'
 
-#isbn_data = bencodepy.bread(zstandard.ZstdDecompressor().stream_reader(open(input_filename, 'rb')))
-isbn_data = bencodepy.decode(zstandard.ZstdDecompressor().stream_reader(open(input_filename, 'rb')).read())
+# Memory-mapped run arrays by dataset name, converted once into the on-disk store
+isbn_data = D.load_isbn_data(input_filename)
 smaller_scale = 10
 
 def color_image(image, packed_isbns_binary, color=None, addcolor=None, scale=1):
-    packed_isbns_ints = struct.unpack(f'{len(packed_isbns_binary) // 4}I', packed_isbns_binary)
-    isbn_streak = True # Alternate between reading `isbn_streak` and `gap_size`.
-    position = 0 # ISBN (without check digit) is `978000000000 + position`.
-    for value in tqdm.tqdm(packed_isbns_ints):
-        if isbn_streak:
-            for _ in range(0, value):
-                x = (position // scale) % image.width
-                y = (position // scale) // image.width
-                if color is not None:
-                    image.putpixel((x, y), color)
-                else:
-                    image.putpixel((x, y), addcolor + image.getpixel((x,y)))
-                position += 1
-        else: # Reading `gap_size`.
-            position += value
-        isbn_streak = not isbn_streak
+    """
+    Paint one dataset onto `image`, a NumPy array of shape (height, width) or
+    (height, width, channels). Cell `position // scale` is laid out
+    `width` cells per row. With `addcolor` every ISBN adds it to its cell,
+    with `color` every cell holding an ISBN is set to it. Per-cell counts come
+    from the streak index (see density.bucket_counts), so runs are never
+    expanded into single ISBNs.
+    """
+    height, width = image.shape[:2]
+    starts, ends = streak_bounds(decode_runs(packed_isbns_binary))
+    counts = bucket_counts(starts, ends, scale, width * height).reshape(height, width)
+    if color is not None:
+        image[counts > 0] = color
+    else:
+        weights = counts if image.ndim == 2 else counts[..., np.newaxis]
+        image += (weights * np.asarray(addcolor, dtype=image.dtype)).astype(image.dtype)
+
+def to_luminance(image):
+    """Float image in [0, 1] to 8 bits, as PIL's point(x * 255).convert("L") does (truncated and clipped)."""
+    return np.clip(image * 255, 0, 255).astype(np.uint8)
+
+def compose(red, green):
+    """RGB image of a float `red` layer minus `green`, with `green` on top, as a PIL image."""
+    red, green = to_luminance(red), to_luminance(green)
+    rgb = np.zeros(red.shape + (3,), dtype=np.uint8)
+    np.subtract(red, green, out=rgb[..., 0], where=red > green)
+    rgb[..., 1] = green
+    return PIL.Image.fromarray(rgb, "RGB")
+
+def density_layer(packed_isbns_binary, scale):
+    """Fraction of the `scale * scale` positions of every 1:`scale` cell that hold an ISBN, as float32."""
+    layer = np.zeros((40000//scale, 50000//scale), dtype=np.float32)
+    color_image(layer, packed_isbns_binary, addcolor=1.0/float(scale*scale), scale=(scale*scale))
+    return layer
 
 def generate_global_view(grid_width, grid_height, scale):
-    print("### Generating 1:{scale} image...")
-    all_isbns_png_smaller_red = PIL.Image.new("F", (50000//scale, 40000//scale), 0.0)
-    all_isbns_png_smaller_green = PIL.Image.new("F", (50000//scale, 40000//scale), 0.0)
+    print(f"### Generating 1:{scale} image...")
+    all_isbns_png_smaller_red = np.zeros((40000//scale, 50000//scale), dtype=np.float32)
     for prefix, packed_isbns_binary in isbn_data.items():
-        if prefix == b'md5':
+        if prefix == 'md5':
             continue
-        print(f"Adding {prefix.decode()} to images/all_isbns_smaller.png")
-        color_image(all_isbns_png_smaller_red, packed_isbns_binary, addcolor=1.0/float(scale*scale), scale=(scale*scale))
+        print(f"Adding {prefix} to images/all_isbns_smaller.png")
+        all_isbns_png_smaller_red += density_layer(packed_isbns_binary, scale)
     print(f"Adding md5 to images/all_isbns_smaller.png")
-    color_image(all_isbns_png_smaller_green, isbn_data[b'md5'], addcolor=1.0/float(scale*scale), scale=(scale*scale))
-    PIL.Image.merge('RGB', (
-        PIL.ImageChops.subtract(all_isbns_png_smaller_red.point(lambda x: x * 255).convert("L"), all_isbns_png_smaller_green.point(lambda x: x * 255).convert("L")),
-        all_isbns_png_smaller_green.point(lambda x: x * 255).convert("L"),
-        PIL.Image.new('L', all_isbns_png_smaller_red.size, 0),
-    )).save(f"all_isbns_1_{scale}.png")
+    all_isbns_png_smaller_green = density_layer(isbn_data['md5'], scale)
+    compose(all_isbns_png_smaller_red, all_isbns_png_smaller_green).save(f"all_isbns_1_{scale}.png")
 
     print("done")
 
@@ -61,7 +74,7 @@ def generate_global_view_overlay(grid_width, grid_height, scale):
 
     # read the json out
     import json
-    all_books = {}
+    datasets = {}
     try:
         with open("./datasets.json", "r") as f:
             datasets = json.load(f)
@@ -69,68 +82,38 @@ def generate_global_view_overlay(grid_width, grid_height, scale):
         pass
 
     print(f"### Generating 1:{scale} image...")
-    all_isbns_png_smaller_red = PIL.Image.new("F", (50000//scale, 40000//scale), 0.0)
+    # Every prefix layer is computed once and reused for the combined layer
+    layers = {}
     for prefix, packed_isbns_binary in isbn_data.items():
-        print(f"Adding {prefix.decode()} to images of all")
-        color_image(all_isbns_png_smaller_red, packed_isbns_binary, addcolor=1.0/float(scale*scale), scale=(scale*scale))
+        print(f"Adding {prefix} to images of all")
+        layers[prefix] = density_layer(packed_isbns_binary, scale)
+    all_isbns_png_smaller_red = np.sum(list(layers.values()), axis=0, dtype=np.float32)
 
     for prefix, packed_isbns_binary in isbn_data.items():
-        all_isbns_png_smaller_green = PIL.Image.new("F", (50000//scale, 40000//scale), 0.0)
-        # make a copy for all_isbns_png_smaller_red
-        prefix_decoded = prefix.decode()
-        datasets[prefix_decoded] = len(packed_isbns_binary) // 4
-        all_isbns_png_smaller_red_copy = all_isbns_png_smaller_red.copy()
+        prefix_decoded = prefix
+        datasets[prefix_decoded] = int(decode_runs(packed_isbns_binary)[0::2].sum(dtype=np.int64))
         print(f"Adding {prefix} to images/all_isbns_{prefix}_1_{scale}.png")
-        color_image(all_isbns_png_smaller_green, isbn_data[prefix], addcolor=1.0/float(scale*scale), scale=(scale*scale))
-        PIL.Image.merge('RGB', (
-            PIL.ImageChops.subtract(all_isbns_png_smaller_red_copy.point(lambda x: x * 255).convert("L"), all_isbns_png_smaller_green.point(lambda x: x * 255).convert("L")),
-            all_isbns_png_smaller_green.point(lambda x: x * 255).convert("L"),
-            PIL.Image.new('L', all_isbns_png_smaller_red.size, 0),
-        )).save(f"all_isbns_{prefix_decoded}_1_{scale}.png")
+        compose(all_isbns_png_smaller_red, layers[prefix]).save(f"all_isbns_{prefix_decoded}_1_{scale}.png")
 
 
     with open("./datasets.json", "w") as f:
         json.dump(datasets, f, indent=4)
     # also update the list of records in the json file of "../all_books.json" which is not dictionary but list of records
-    update_all_books(datasets)
+    stats.update_all_books(datasets)
 
     print("done")
 
 
 def count_total_isbns(isbn_data):
-    with open('./datasets.json', 'r') as f:
-        datasets = json.load(f)
-
-    for prefix, packed_isbns_binary in isbn_data.items():
-        dataset_count = 0
-        packed_isbns_ints = struct.unpack(f'{len(packed_isbns_binary) // 4}I', packed_isbns_binary)
-        isbn_streak = True  # Toggle between counting and skipping
-
-        for value in tqdm.tqdm(packed_isbns_ints):
-            if isbn_streak:
-                dataset_count += value  # Add to the total count
-            # Switch between counting ISBNs and skipping gaps
-            isbn_streak = not isbn_streak
-        print (f"Total ISBNs for {prefix.decode()}: {dataset_count}")
-        datasets[prefix.decode()] = dataset_count
-
-    with open('./datasets.json', 'w') as f:
-        json.dump(datasets, f, indent=4)
-
-    with open('../all_books.json', 'r') as f:
-        all_books = json.load(f)
-
-    # Update the count for each matching prefix
-    for book in all_books:
-        prefix = book['prefix']
-        if prefix in datasets:
-            book['count'] = datasets[prefix]
-
-    # Save the updated data back to all_books.json
-    with open('../all_books.json', 'w') as f:
-        json.dump(all_books, f, indent=2)
+    # Counts come from vectorized sums over the runs, see stats.py
+    all_stats = stats.compute_stats(isbn_data)
+    counts = {prefix: s["count"] for prefix, s in all_stats.items()}
+    for prefix, count in counts.items():
+        print(f"Total ISBNs for {prefix}: {count}")
 
-    print("all_books.json has been updated.")
+    stats.write_datasets(counts)
+    stats.update_all_books(counts)
+    stats.write_tile_counts(all_stats)
 
 
 
@@ -145,5 +128,5 @@ def count_total_isbns(isbn_data):
 # all prefixes in the data: [b'cadal_ssno', b'cerlalc', b'duxiu_ssid', b'edsebk', b'gbooks', b'goodreads', b'ia', b'isbndb', b'isbngrp', b'libby', b'md5', b'nexusstc', b'nexusstc_download', b'oclc', b'ol', b'rgb', b'trantor']
 # generate_global_view_overlay(50000, 40000, 50)      # 1: 10
 
-#count_total_isbns(isbn_data)
-count_total_isbns(isbn_data)
\ No newline at end of file
+if __name__ == "__main__":
+    count_total_isbns(isbn_data)
@@ -1,17 +1,157 @@
 # serve_visual.py
-from flask import Flask, request, jsonify
+from flask import Flask, Response, abort, make_response, request, jsonify, stream_with_context
 from flask_cors import CORS
 
-from bitmap_manager import BitmapManager
+from bitmap_manager import normalize_grid
+from density import DensityPyramid, bucket_counts, SCALES as DENSITY_SCALES
+from rasterizer import GRID_WIDTH, GRID_HEIGHT
+from tile_cache import TileCache
+from interval_sets import OPERATIONS
+from rare_index import load_rarebook_index, search_titles
+from isbn_runs import isbn13_numbers, normalize_isbns
+import metrics
 import tools.data_loader as data_loader
+import gzip
+import hashlib
 import json
+import os
+import sqlite3
+import threading
+import numpy as np
+import zstandard
 
+BITS_MIMETYPE = "application/octet-stream"
+MAX_DENSITY_CELLS = 2000000
+TILE_WIDTH = 1000
+TILE_HEIGHT = 800
+TILE_MAX_AGE = 24 * 60 * 60  # Tiles only change with a new snapshot
+TILE_CACHE_BYTES = 256 * 1024 * 1024
+START_ISBN = 978000000000
+MAX_BATCH_ISBNS = 1000000
+MAX_RAREBOOKS = 5000
+MAX_SEARCH_RESULTS = 500
+RAREBOOK_DB = "tools/rare_books/rare_books.db"
+RAREBOOK_TILES = "static/data/rarebooks"
+EXPOSE_HEADERS = ["X-Start-ISBN", "X-Length", "X-Width", "X-Height", "X-Count", "X-Next-Cursor"]
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=EXPOSE_HEADERS)
+# Latency, size and cache metrics per route at /metrics; Server-Timing on `X-Server-Timing: 1`
+app.config["SERVER_TIMING"] = os.environ.get("SERVER_TIMING") == "1"
+metrics.instrument(app)
 
-# Create a BitmapManager instance
-bitmap_manager = data_loader.load_bitmap_manager("aa_isbn13_codes_20241204T185335Z.benc.zst", 978000000000)
+# One registry for all datasets; managers are built on first use. Loaded by
+# init_data, on the first request or up front by serve.py
+registry = None
+init_lock = threading.Lock()
+
+
+def get_dataset():
+    """Dataset named by the `dataset=` query parameter (gbooks by default)."""
+    dataset = request.args.get("dataset", default=registry.default)
+    if dataset not in registry:
+        abort(make_response(jsonify({"error": f"unknown dataset: {dataset}", "datasets": registry.names}), 404))
+    return dataset
+
+
+def get_manager():
+    """BitmapManager for the `dataset=` query parameter."""
+    return registry.get(get_dataset())
+
+
+global_views = {}  # Serialized /api/global_view grids by dataset
+tile_cache = TileCache(TILE_CACHE_BYTES)  # Rendered /api/get_tile bodies
+metrics.REGISTRY.register(metrics.Gauge("tile_cache_bytes", "Size of the cached /api/get_tile bodies.",
+                                        lambda: tile_cache.size))
+metrics.REGISTRY.register(metrics.Gauge("tile_cache_entries", "Number of cached /api/get_tile bodies.",
+                                        lambda: len(tile_cache)))
+rarebooks = None  # RarebookIndex, loaded on first use
+rarebooks_lock = threading.Lock()
+
+
+def init_data(input_filename=data_loader.INPUT_FILENAME, store_dir=data_loader.STORE_DIR, preload=False):
+    """
+    Serve the snapshot `input_filename`, replacing any previous one along with
+    everything cached from it. With `preload`, every dataset's index is built
+    now instead of on first use, e.g. in the pre-fork master of serve.py.
+    """
+    global registry, rarebooks
+    loaded = data_loader.load_bitmap_registry(input_filename, START_ISBN, store_dir=store_dir)
+    if preload:
+        for name in loaded.names:
+            loaded.get(name)
+    registry = loaded
+    rarebooks = None
+    global_views.clear()
+    tile_cache.clear()
+    return loaded
+
+
+@app.before_request
+def ensure_data():
+    """Load the default snapshot on the first request unless init_data already ran."""
+    if registry is None:
+        with init_lock:
+            if registry is None:
+                init_data()
+
+
+def get_rarebooks():
+    """Rare-book index, with the `e` flag taken from the md5 dataset when the database is the source."""
+    global rarebooks
+    if rarebooks is None:
+        # Concurrent first requests wait for one build instead of each building the index
+        with rarebooks_lock:
+            if rarebooks is None:
+                existence = None
+                if "md5" in registry:
+                    existence = lambda isbns: registry.get("md5").is_available_many(isbns).astype(np.uint8)
+                rarebooks = load_rarebook_index(RAREBOOK_DB, RAREBOOK_TILES, existence)
+    return rarebooks
+
+
+def wants_bits():
+    """True if the client asked for bit-packed occupancy (`?format=bits` or by Accept header)."""
+    if request.args.get("format") == "bits":
+        return True
+    return request.accept_mimetypes.best_match(["application/json", BITS_MIMETYPE]) == BITS_MIMETYPE
+
+
+def bits_encoding():
+    """Pick the compression for a bits payload: `?compress=` wins over Accept-Encoding."""
+    requested = request.args.get("compress")
+    if requested is not None:
+        return requested if requested in ("zstd", "gzip") else None
+    for encoding in ("zstd", "gzip"):
+        if encoding in request.accept_encodings:
+            return encoding
+    return None
+
+
+def bits_response(exists, position, width=None):
+    """
+    Bit-packed (MSB first, `np.packbits`) occupancy response. The start ISBN
+    and number of bits travel in headers; rows are `X-Width` bits for 2D data.
+    """
+    with metrics.span("serialize"):
+        payload = np.packbits(exists).tobytes()
+    encoding = bits_encoding()
+    with metrics.span("compress"):
+        if encoding == "zstd":
+            payload = zstandard.ZstdCompressor(level=3).compress(payload)
+        elif encoding == "gzip":
+            payload = gzip.compress(payload, compresslevel=6)
+
+    response = Response(payload, mimetype=BITS_MIMETYPE)
+    response.headers["X-Start-ISBN"] = str(int(isbn13_numbers(START_ISBN + position)))
+    response.headers["X-Length"] = str(exists.size)
+    if width:
+        response.headers["X-Width"] = str(width)
+        response.headers["X-Height"] = str(exists.size // width)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.update(("Accept", "Accept-Encoding"))
+    return response
 
 # return homepage for the client to render the visualization based on a template file
 @app.route("/")
@@ -28,86 +168,309 @@ def prototype():
 
 @app.route("/api/isbn/<isbn>", methods=["GET"])
 def get_isbn(isbn):
-    if bitmap_manager.is_available(isbn):
+    normalized, valid = normalize_isbns([isbn])
+    if not valid[0]:
+        return jsonify({"error": f"invalid ISBN: {isbn}"}), 400
+    if get_manager().is_available(str(normalized[0])):
         return jsonify({"status": "available"})
     else:
         return jsonify({"status": "unavailable"})
-    
+
+
+@app.route("/api/isbn/<isbn>/sources", methods=["GET"])
+def get_isbn_sources(isbn):
+    """
+    Which datasets hold `isbn` (ISBN-10 or 13, hyphens allowed): bit `i` of
+    `mask` stands for `datasets[i]`. Returns the normalized ISBN-13.
+    """
+    normalized, valid = normalize_isbns([isbn])
+    if not valid[0]:
+        return jsonify({"error": f"invalid ISBN: {isbn}"}), 400
+    mask = int(registry.sources_many(normalized)[0])
+    return jsonify({"isbn": str(normalized[0]), "mask": mask, "sources": registry.mask_names(mask),
+                    "datasets": registry.names})
+
+@app.route("/api/isbn/batch", methods=["POST"])
+def post_isbn_batch():
+    """
+    Look up many ISBNs at once. The body is a JSON list, {"isbns": [...]} or
+    newline-separated text of ISBN-10/13s (a leading BOM is ignored),
+    optionally gzip-compressed. Returns columns in input order: the normalized ISBN-13 (null if
+    invalid) and its membership bitmask, where bit `i` stands for `datasets[i]`.
+    """
+    body = request.get_data()
+    if request.headers.get("Content-Encoding") == "gzip" or body[:2] == b"\x1f\x8b":
+        try:
+            body = gzip.decompress(body)
+        except (OSError, EOFError):
+            return jsonify({"error": "invalid gzip body"}), 400
+
+    if request.mimetype == "application/json":
+        try:
+            isbns = json.loads(body)
+        except ValueError:
+            return jsonify({"error": "invalid JSON body"}), 400
+        if isinstance(isbns, dict):
+            isbns = isbns.get("isbns")
+        if not isinstance(isbns, list):
+            return jsonify({"error": "expected a list of ISBNs or {\"isbns\": [...]}"}), 400
+    else:
+        isbns = [line for line in body.decode("utf-8-sig", errors="replace").splitlines() if line.strip()]
+    if len(isbns) > MAX_BATCH_ISBNS:
+        return jsonify({"error": f"at most {MAX_BATCH_ISBNS} ISBNs per request"}), 413
+
+    normalized, valid = normalize_isbns(isbns)
+    masks = np.zeros(len(isbns), dtype=np.uint32)
+    masks[valid] = registry.sources_many(normalized[valid])
+    return jsonify({
+        "datasets": registry.names,
+        "count": len(isbns),
+        "valid": int(valid.sum()),
+        "isbns": [str(isbn) if ok else None for isbn, ok in zip(normalized.tolist(), valid.tolist())],
+        "masks": masks.tolist(),
+    })
+
+@app.route("/api/sets/<operation>", methods=["GET"])
+def get_set_operation(operation):
+    """
+    Exact union / intersection / difference of datasets, e.g.
+    /api/sets/difference?datasets=oclc,md5. Returns the cardinality, or with
+    `list=1` streams the resulting ISBN-13s one per line (up to `limit`).
+    """
+    names = [name for name in request.args.get("datasets", default="").split(",") if name]
+    if operation not in OPERATIONS or not names:
+        return jsonify({"error": "operation must be one of " + ", ".join(sorted(OPERATIONS)) + " with datasets=a,b"}), 400
+    unknown = [name for name in names if name not in registry]
+    if unknown:
+        return jsonify({"error": f"unknown datasets: {', '.join(unknown)}", "datasets": registry.names}), 404
+
+    result = OPERATIONS[operation](*[registry.get(name).intervals for name in names])
+    count = result.cardinality()
+    if not request.args.get("list", type=int):
+        return jsonify({"operation": operation, "datasets": names, "count": count})
+
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit <= 0:
+        return jsonify({"error": "limit must be positive"}), 400
+    limit = count if limit is None else min(limit, count)
+
+    def generate():
+        remaining = limit
+        if remaining <= 0:
+            return
+        for isbns in result.iter_isbns(registry.start_isbn, chunk_size=100000):
+            isbns = isbns[:remaining]
+            if len(isbns):
+                yield "\n".join(map(str, isbns.tolist())) + "\n"
+            remaining -= len(isbns)
+            if remaining <= 0:
+                break
+
+    response = Response(stream_with_context(generate()), mimetype="text/plain")
+    response.headers["X-Count"] = str(count)
+    return response
+
+
 # get n samples of the data
 @app.route("/api/samples/<int:n>", methods=["GET"])
 def get_n_samples(n):
-    return jsonify(bitmap_manager.extract_isbns(n=n))
+    return jsonify(get_manager().extract_isbns(n=n))
 
     
 @app.route("/api/isbns", methods=["GET"])
 def get_isbns():
-    return jsonify(bitmap_manager.extract_isbns())
+    """
+    Stream the dataset's ISBN-13s as newline-delimited JSON strings, in
+    ascending order. `start`/`stop` bound the range by ISBN-13, `limit` caps
+    the page and `cursor` resumes after the last ISBN of a previous page;
+    when more ISBNs follow, that ISBN is sent as X-Next-Cursor.
+    """
+    bitmap_manager = get_manager()
+    start = request.args.get("start", type=int)
+    cursor = request.args.get("cursor", type=int)
+    if cursor is not None:
+        start = (cursor // 10 + 1) * 10
+    stop = request.args.get("stop", type=int)
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit <= 0:
+        return jsonify({"error": "limit must be positive"}), 400
+    first, last = bitmap_manager.rank_range(start, stop, limit)
+
+    def generate():
+        for isbns in bitmap_manager.iter_isbn_batches(start, stop, limit):
+            yield "".join(f'"{isbn}"\n' for isbn in isbns.tolist())
+
+    response = Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    response.headers["X-Count"] = str(last - first)
+    if first < last < bitmap_manager.rank_range(start, stop)[1]:
+        response.headers["X-Next-Cursor"] = str(bitmap_manager.isbn_at(last - 1))
+    return response
 
 @app.route("/api/global_view", methods=["GET"])
 def get_global_view():
     grid_width = 1000  # Width of the global view grid
     grid_height = 800  # Height of the global view grid
-    scale = 2500  # Scale factor for aggregating ISBNs
+    bucket = 2500  # Consecutive ISBN positions per cell, 1000 cells per row
 
-    # check if global view data is already generated
-    try:
-        with open("global_view_data.json", "r") as f:
-            global_view_data = json.load(f)
-    except FileNotFoundError:
-        global_view_data = bitmap_manager.generate_global_view(grid_width, grid_height, scale)
-        #save global view data for later use
-        with open("global_view_data.json", "w") as f:
-            json.dump(global_view_data, f)
+    dataset = get_dataset()
+    # Legacy layout: strips of consecutive positions, not the square blocks of
+    # /api/density. Counted from the streak index in one pass over the cell
+    # edges; the serialized grid is kept for the lifetime of the registry
+    metrics.cache_result("global_view", dataset in global_views)
+    if dataset not in global_views:
+        bitmap_manager = registry.get(dataset)
+        counts = bucket_counts(bitmap_manager.streak_starts, bitmap_manager.streak_ends, bucket,
+                               grid_width * grid_height).reshape(grid_height, grid_width)
+        global_view_data = np.zeros((grid_height, grid_width, 3), dtype=int)
+        global_view_data[:, :, 1] = counts  # Green for artifacts
+        global_views[dataset] = jsonify(normalize_grid(global_view_data).tolist()).get_data()
+
+    return Response(global_views[dataset], mimetype="application/json")
+
+
+@app.route("/api/density", methods=["GET"])
+def get_density():
+    """
+    ISBN counts per cell for the viewport [x0, x1) x [y0, y1) at 1:`scale`
+    (1, 5, 10, 25, 50 or 100). A cell counts the `scale` x `scale` block of
+    the 1:1 map it covers, as a pixel of the map tiles does, so a rectangle
+    covers the same ISBNs at every scale (see density.py).
+    """
+    scale = request.args.get("scale", default=50, type=int)
+    if scale != 1 and scale not in DENSITY_SCALES:
+        return jsonify({"error": f"scale must be one of {[1] + list(DENSITY_SCALES)}"}), 400
+    height, width = DensityPyramid.shape(scale)
+    x0 = max(request.args.get("x0", default=0, type=int), 0)
+    y0 = max(request.args.get("y0", default=0, type=int), 0)
+    x1 = min(request.args.get("x1", default=width, type=int), width)
+    y1 = min(request.args.get("y1", default=height, type=int), height)
+    if x1 <= x0 or y1 <= y0:
+        return jsonify({"error": "empty viewport"}), 400
+    if (x1 - x0) * (y1 - y0) > MAX_DENSITY_CELLS:
+        return jsonify({"error": f"viewport larger than {MAX_DENSITY_CELLS} cells"}), 400
 
-    return jsonify(global_view_data)
+    counts = registry.density_counts(get_dataset(), scale, x0, y0, x1, y1)
+
+    return jsonify({"scale": scale, "x0": x0, "y0": y0, "width": x1 - x0, "height": y1 - y0, "counts": counts.tolist()})
 
 
 @app.route("/api/cluster_view", methods=["GET"])
 def get_cluster_view():
     base_isbn = request.args.get("base_isbn", default=None, type=str)
     n = 800000  # Number of ISBNs for cluster view
+    bitmap_manager = get_manager()
 
     # Fetch ISBN existence data
-    if base_isbn:
-        cluster_data = bitmap_manager.check_isbns_from(start_isbn=base_isbn, n=n)
-    else:
-        cluster_data = bitmap_manager.check_isbns(n=n)
+    position = max(bitmap_manager.relative_position(base_isbn), 0) if base_isbn else 0
+    cluster_data = bitmap_manager.check_window(position, n=n)
+    if wants_bits():
+        return bits_response(cluster_data, position)
 
     # Convert to a compact array for the frontend
-    compact_data = [1 if item["exists"] else 0 for item in cluster_data]
+    compact_data = cluster_data.astype(np.uint8).tolist()
 
     return jsonify(compact_data)
 
+@app.route("/api/rarebooks", methods=["GET"])
+def get_rarebooks_view():
+    """
+    Rare books inside the viewport [x0, x1) x [y0, y1) of the 50000 x 40000
+    grid, optionally with at most `max_holdings` holdings. The rarest come
+    first, capped at `limit`; `total` counts every match in the viewport.
+    Records use the tile format ({"i", "t", "h", "e"}) plus global x/y.
+    """
+    x0 = request.args.get("x0", type=int)
+    y0 = request.args.get("y0", type=int)
+    x1 = request.args.get("x1", type=int)
+    y1 = request.args.get("y1", type=int)
+    if None in (x0, y0, x1, y1):
+        return jsonify({"error": "x0, y0, x1 and y1 are required"}), 400
+    if x1 <= x0 or y1 <= y0:
+        return jsonify({"error": "empty viewport"}), 400
+    max_holdings = request.args.get("max_holdings", type=int)
+    limit = min(request.args.get("limit", default=1000, type=int), MAX_RAREBOOKS)
+    if limit <= 0:
+        return jsonify({"error": "limit must be positive"}), 400
+
+    index = get_rarebooks()
+    rows, total = index.query(x0, y0, x1, y1, max_holdings, limit)
+    return jsonify({"total": total, "count": len(rows), "books": index.records(rows)})
+
+
+@app.route("/api/search", methods=["GET"])
+def get_search():
+    """
+    Rare books whose title contains every word of `q` as a prefix, optionally
+    with `min_holdings`/`max_holdings`. Pages of `limit` books; pass the
+    returned `next_cursor` as `cursor` for the next page.
+    """
+    query = request.args.get("q", default="").strip()
+    if not query:
+        return jsonify({"error": "q is required"}), 400
+    limit = min(request.args.get("limit", default=50, type=int), MAX_SEARCH_RESULTS)
+    if limit <= 0:
+        return jsonify({"error": "limit must be positive"}), 400
+    if not os.path.exists(RAREBOOK_DB):
+        return jsonify({"error": "rare-book database not available"}), 503
+
+    try:
+        books, next_cursor = search_titles(
+            RAREBOOK_DB, query,
+            min_holdings=request.args.get("min_holdings", type=int),
+            max_holdings=request.args.get("max_holdings", type=int),
+            limit=limit,
+            cursor=request.args.get("cursor", type=int),
+        )
+    except sqlite3.OperationalError as e:
+        return jsonify({"error": f"search unavailable: {e}"}), 503
+    # Existence in Anna's Archive (md5), as the `e` flag of the rare-book tiles
+    exists = [False] * len(books)
+    if books and "md5" in registry:
+        exists = registry.get("md5").is_available_many([book["i"] for book in books]).tolist()
+    for book, e in zip(books, exists):
+        book["e"] = int(e)
+    return jsonify({"query": query, "count": len(books), "books": books, "next_cursor": next_cursor})
+
+
 @app.route("/api/get_tile", methods=["GET"])
 def get_tile():
     """
-    Serve a specific 1000x1000 tile of the global ISBN universe.
+    Serve one 1000x800 tile of the global ISBN universe, addressed like the
+    rendered map tiles and the rare-book tiles (50 x 50 tiles over the
+    50000-wide grid, see sort_tile.calculate_tile_position).
     """
     tile_x = request.args.get("tile_x", type=int)
     tile_y = request.args.get("tile_y", type=int)
-    tile_size = 1000  # Tile dimensions
 
     if tile_x is None or tile_y is None:
         return jsonify({"error": "tile_x and tile_y are required"}), 400
+    if not (0 <= tile_x < GRID_WIDTH // TILE_WIDTH and 0 <= tile_y < GRID_HEIGHT // TILE_HEIGHT):
+        return jsonify({"error": "tile_x and tile_y must address a tile of the 50 x 50 grid"}), 400
 
-    # Calculate the base ISBN for the requested tile
-    # base_isbn = (
-    #     tile_y * 2500 * tile_size  # Rows of 2500 blocks
-    #     + tile_x * tile_size
-    #     + 978000000000  # Global starting ISBN
-    # )
-    base_isbn = "9798217294478" # hardcoded for now
-    # Fetch ISBN data for this tile
-    cluster_data = bitmap_manager.check_isbns_from(start_isbn=base_isbn, n=tile_size * tile_size)
-
-    # Format the data as a 1000x1000 grid
-    compact_data = [
-        [1 if item["exists"] else 0 for item in cluster_data[row : row + tile_size]]
-        for row in range(0, len(cluster_data), tile_size)
-    ]
-
-    return jsonify({"tile_x": tile_x, "tile_y": tile_y, "data": compact_data})
+    dataset = get_dataset()
+    bits = wants_bits()
+    key = (registry.source, dataset, tile_x, tile_y, bits_encoding() if bits else "json")
+    cached = tile_cache.get(key)
+    metrics.cache_result("tile", cached is not None)
+    if cached is None:
+        tile_data = registry.get(dataset).tile(tile_x, tile_y, TILE_WIDTH, TILE_HEIGHT, GRID_WIDTH)
+        if bits:
+            # First position of the tile: its top-left corner
+            position = tile_y * TILE_HEIGHT * GRID_WIDTH + tile_x * TILE_WIDTH
+            response = bits_response(tile_data, position, width=TILE_WIDTH)
+        else:
+            response = jsonify({"tile_x": tile_x, "tile_y": tile_y, "data": tile_data.astype(np.uint8).tolist()})
+        body = response.get_data()
+        cached = (body, {"headers": dict(response.headers), "etag": hashlib.sha1(body).hexdigest()})
+        tile_cache.put(key, body, **cached[1])
 
+    body, meta = cached
+    response = Response(body, headers=meta["headers"])
+    response.set_etag(meta["etag"])
+    response.cache_control.public = True
+    response.cache_control.max_age = TILE_MAX_AGE
+    response.vary.update(("Accept", "Accept-Encoding"))
+    return response.make_conditional(request)
 
 
 @app.route("/api/detail_view", methods=["GET"])
@@ -115,6 +478,11 @@ def get_detail_view():
     # Fetch the base ISBN from query parameters
     base_isbn = request.args.get("base_isbn", default=None, type=str)
     n = 100  # Number of ISBNs for detail view
+    bitmap_manager = get_manager()
+
+    if wants_bits():
+        position = max(bitmap_manager.relative_position(base_isbn), 0) if base_isbn else 0
+        return bits_response(bitmap_manager.check_window(position, n=n), position)
 
     if base_isbn:
         detail_data = bitmap_manager.check_isbns_from(start_isbn=base_isbn, n=n)
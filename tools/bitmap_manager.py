@@ -1,164 +1,242 @@
-import struct
-import isbnlib
+import threading
 import numpy as np
 
+from density import DensityPyramid, bucket_counts, block_counts, load_or_build
+from interval_sets import IntervalSet
+from metrics import span
+from isbn_runs import (decode_runs, streak_bounds, contains, occupancy, rect_occupancy, isbn13_numbers,
+                       cumulative_lengths, member_rank, member_positions)
+
+
+def normalize_grid(grid):
+    """Normalize values for visualization (0-255)."""
+    peak = grid.max()
+    return (grid / peak * 255).astype(int) if peak else grid.astype(int)
+
 
 class BitmapManager:
     def __init__(self, packed_isbns_binary, start_isbn=978000000000):
-        # Decode the binary data into integers
+        # Decode the binary data (or take the memory-mapped run array) as uint32 integers
         self.packed_isbns_binary = packed_isbns_binary
-        self.packed_isbns_ints = struct.unpack(f'{len(packed_isbns_binary) // 4}I', packed_isbns_binary)
+        self.packed_isbns_ints = runs = decode_runs(packed_isbns_binary)
         self.start_isbn = start_isbn
+        # Cumulative position index: streak `i` covers [streak_starts[i], streak_ends[i])
+        self.streak_starts, self.streak_ends = streak_bounds(runs)
+        # Number of positions (streaks and gaps) covered by the data
+        self.total_positions = int(runs.sum(dtype=np.int64))
+        # Members before each streak, so ranks and counts need no pass over the data
+        self.lengths_before = cumulative_lengths(self.streak_starts, self.streak_ends)
+        self.total_isbns = int(self.lengths_before[-1])
+
+    def rank_range(self, start=None, stop=None, limit=None):
+        """Ranks [first, last) of the member ISBNs selected by `start`, `stop` and `limit` (see iter_isbn_batches)."""
+        first = 0 if start is None else self.rank(start)
+        last = self.total_isbns if stop is None else self.rank(stop)
+        if limit is not None:
+            last = min(last, first + limit)
+        return first, max(first, last)
+
+    def rank(self, isbn):
+        """Number of member ISBNs below ISBN-13 `isbn`."""
+        return member_rank(self.streak_starts, self.streak_ends, int(isbn) // 10 - self.start_isbn, self.lengths_before)
+
+    def isbn_at(self, rank):
+        """The member ISBN-13 (as an integer) of the given rank."""
+        position = member_positions(self.streak_starts, self.streak_ends, rank, 1, self.lengths_before)
+        return int(isbn13_numbers(self.start_isbn + position)[0])
+
+    def iter_isbn_batches(self, start=None, stop=None, limit=None, batch_size=100000):
+        """
+        Lazily yield the ISBN-13s (as int64 arrays of at most `batch_size`) in
+        ascending order, from ISBN-13 `start` (inclusive) to `stop`
+        (exclusive), at most `limit` of them. Bounds are ISBN-13s with or
+        without a valid check digit, as strings or integers.
+        """
+        first, last = self.rank_range(start, stop, limit)
+        for rank in range(first, last, batch_size):
+            positions = member_positions(self.streak_starts, self.streak_ends, rank, min(batch_size, last - rank),
+                                         self.lengths_before)
+            yield isbn13_numbers(self.start_isbn + positions)
+
+    def iter_isbns(self, start=None, stop=None, limit=None):
+        """Lazily yield the ISBN-13 strings, see iter_isbn_batches."""
+        for isbns in self.iter_isbn_batches(start, stop, limit):
+            yield from map(str, isbns.tolist())
 
     def extract_isbns(self, n = 0):
-        """Extract all ISBNs from the bitmap."""
-        isbn_streak = True  # Alternate between reading `isbn_streak` and `gap_size`
-        position = 0  # ISBN position (without check digit)
-        extracted_isbns = []
-
-        i = 0
-        for value in self.packed_isbns_ints:
-            if isbn_streak:  # Reading `isbn_streak`
-                for _ in range(value):
-                    isbn13_without_check = str(self.start_isbn + position)
-                    check_digit = isbnlib.check_digit13(isbn13_without_check)
-                    isbn13 = f"{isbn13_without_check}{check_digit}"
-                    extracted_isbns.append(isbn13)
-                    position += 1
-            else:  # Reading `gap_size`
-                position += value
-            isbn_streak = not isbn_streak
-            i += 1
-            if i == n:
-                break
-
-        return extracted_isbns
+        """Extract the first `n` ISBNs from the bitmap (all of them if `n` is 0)."""
+        return list(self.iter_isbns(limit=n or None))
+
+    @property
+    def intervals(self):
+        """The dataset as an IntervalSet, for exact set algebra with other datasets."""
+        return IntervalSet(self.streak_starts, self.streak_ends)
 
     def is_available(self, isbn):
         """Check if a specific ISBN is available."""
         isbn_without_check = isbn[:-1]  # Remove the check digit
         position = int(isbn_without_check) - self.start_isbn
+        return bool(contains(self.streak_starts, self.streak_ends, [position])[0])
 
-        # Decode the streaks and gaps
-        streak_flag = True
-        current_position = 0
-
-        for value in self.packed_isbns_ints:
-            if streak_flag:  # Reading `isbn_streak`
-                if current_position <= position < current_position + value:
-                    return True
-                current_position += value
-            else:  # Reading `gap_size`
-                current_position += value
-            streak_flag = not streak_flag
-
-        return False
+    def is_available_many(self, isbns):
+        """
+        Check a batch of ISBN-13s (strings or integers, with check digit) at once.
+        Returns a boolean NumPy array in the same order as `isbns`.
+        """
+        isbns = np.asarray(isbns)
+        if isbns.size == 0:
+            return np.zeros(0, dtype=bool)
+        positions = isbns.astype(np.int64) // 10 - self.start_isbn
+        return contains(self.streak_starts, self.streak_ends, positions)
     
     def generate_global_view(self, grid_width, grid_height, scale):
         """Generate a grid for the global view."""
         grid = np.zeros((grid_height, grid_width, 3), dtype=int)  # RGB channels
-        position = 0
-        isbn_streak = True
+        # ISBNs per cell of `scale` consecutive positions, from cumulative counts at the cell edges
+        with span("decode"):
+            counts = bucket_counts(self.streak_starts, self.streak_ends, scale, grid_width * grid_height)
+        grid[:, :, 1] = counts.reshape(grid_height, grid_width)  # Green for artifacts
+        with span("records"):
+            return normalize_grid(grid).tolist()
+
+    def occupancy(self, position, n):
+        """Boolean existence array for the `n` positions starting at `position`."""
+        return occupancy(self.streak_starts, self.streak_ends, position, n)
+
+    def tile(self, tile_x, tile_y, tile_width=1000, tile_height=800, grid_width=50000):
+        """
+        (tile_height, tile_width) existence array of one map tile, using the same
+        geometry as the rendered tiles: position = row * grid_width + column.
+        """
+        return rect_occupancy(self.streak_starts, self.streak_ends, tile_x * tile_width, tile_y * tile_height,
+                              tile_width, tile_height, grid_width)
 
-        for value in self.packed_isbns_ints:
-            if isbn_streak:
-                for _ in range(value):
-                    x = (position // scale) % grid_width
-                    y = (position // scale) // grid_width
-                    grid[y, x, 1] += 1  # Green for artifacts
-                    position += 1
-            else:
-                position += value  # Gaps
-            isbn_streak = not isbn_streak
+    def isbns_at(self, position, n):
+        """ISBN-13 strings (with check digit) for the `n` positions starting at `position`."""
+        positions = np.arange(position, position + n, dtype=np.int64)
+        return isbn13_numbers(self.start_isbn + positions).astype(str).tolist()
 
-        # Normalize values for visualization (0-255)
-        grid = (grid / grid.max() * 255).astype(int)
-        return grid.tolist()
+    def relative_position(self, isbn):
+        """Position of an ISBN-13 (or its 12-digit prefix) relative to `start_isbn`."""
+        try:
+            isbn_without_check = isbn[:-1] if len(isbn) == 13 else isbn
+            return int(isbn_without_check) - self.start_isbn  # Exclude check digit
+        except ValueError:
+            raise ValueError(f"Invalid start ISBN: {isbn}")
 
+    def check_window(self, position, n=0):
+        """
+        Existence of up to `n` positions starting at `position`, clipped to the
+        end of the data. `n=0` means everything up to the end.
+        """
+        position = max(position, 0)
+        available = max(self.total_positions - position, 0)
+        n = available if n <= 0 else min(n, available)
+        return self.occupancy(position, n)
 
     def check_isbns(self, n=0):
         """Check the existence of the first `n` ISBNs efficiently."""
-        isbn_streak = True
-        position = 0
-        results = []
-        count = 0
-
-        for value in self.packed_isbns_ints:
-            if isbn_streak:  # Reading `isbn_streak`
-                for _ in range(value):
-                    isbn13_without_check = str(self.start_isbn + position)
-                    check_digit = isbnlib.check_digit13(isbn13_without_check)
-                    isbn13 = f"{isbn13_without_check}{check_digit}"
-                    results.append({"isbn": isbn13, "exists": True})
-                    position += 1
-                    count += 1
-                    if count == n:  # Stop once we've checked `n` ISBNs
-                        return results
-            else:  # Reading `gap_size`
-                for _ in range(value):
-                    isbn13_without_check = str(self.start_isbn + position)
-                    check_digit = isbnlib.check_digit13(isbn13_without_check)
-                    isbn13 = f"{isbn13_without_check}{check_digit}"
-                    results.append({"isbn": isbn13, "exists": False})
-                    position += 1
-                    count += 1
-                    if count == n:  # Stop once we've checked `n` ISBNs
-                        return results
-            isbn_streak = not isbn_streak
-
-        return results
+        return self._as_records(0, self.check_window(0, n))
 
     def check_isbns_from(self, start_isbn, n=0):
         """
         Check the existence of `n` ISBNs starting from `start_isbn`.
         """
-        isbn_streak = True
-        position = 0
-        results = []
-        count = 0
+        position = max(self.relative_position(start_isbn), 0)
+        return self._as_records(position, self.check_window(position, n))
 
-        # Calculate the relative position of `start_isbn`
-        try:
-            new_start_isbn = start_isbn[:-1] if len(start_isbn) == 13 else start_isbn
-            relative_position = int(new_start_isbn) - self.start_isbn  # Exclude check digit
-        except ValueError:
-            raise ValueError(f"Invalid start ISBN: {start_isbn}")
-
-        for value in self.packed_isbns_ints:
-            if position + value <= relative_position:
-                # Skip this streak or gap entirely
-                position += value
-                isbn_streak = not isbn_streak
-                continue
-
-            if isbn_streak:  # Reading `isbn_streak`
-                for _ in range(value):
-                    if position >= relative_position:
-                        isbn13_without_check = str(self.start_isbn + position)
-                        check_digit = isbnlib.check_digit13(isbn13_without_check)
-                        isbn13 = f"{isbn13_without_check}{check_digit}"
-                        results.append({"isbn": isbn13, "exists": True})
-                        count += 1
-                        if count == n:  # Stop once we've collected `n` ISBNs
-                            return results
-                    position += 1
-            else:  # Reading `gap_size`
-                for _ in range(value):
-                    if position >= relative_position:
-                        isbn13_without_check = str(self.start_isbn + position)
-                        check_digit = isbnlib.check_digit13(isbn13_without_check)
-                        isbn13 = f"{isbn13_without_check}{check_digit}"
-                        results.append({"isbn": isbn13, "exists": False})
-                        count += 1
-                        if count == n:  # Stop once we've collected `n` ISBNs
-                            return results
-                    position += 1
-
-            isbn_streak = not isbn_streak
-
-        return results
+    def _as_records(self, position, exists):
+        isbns = self.isbns_at(position, len(exists))
+        with span("records"):
+            return [{"isbn": isbn, "exists": flag} for isbn, flag in zip(isbns, exists.tolist())]
 
 
     def __len__(self):
-        return len(self.extract_isbns())
+        return self.total_isbns
     
+
+class BitmapRegistry:
+    """
+    BitmapManagers for every dataset of one snapshot. Managers are created
+    lazily on first use from the shared (memory-mapped) run arrays, so serving
+    another dataset costs only building its streak index.
+    """
+
+    def __init__(self, isbn_data, start_isbn=978000000000, default="gbooks", density_dir=None, source=None):
+        self.isbn_data = isbn_data
+        self.start_isbn = start_isbn
+        self.default = default
+        # Density pyramids built offline for this snapshot (density.py) are read from this directory
+        self.density_dir = density_dir
+        self.source = source
+        self._densities = {}
+        # Bit `i` of a membership mask stands for `names[i]`
+        self.names = sorted(isbn_data)
+        self._managers = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.isbn_data
+
+    def get(self, name=None):
+        """Manager for dataset `name` (the default dataset if None)."""
+        name = name or self.default
+        manager = self._managers.get(name)
+        if manager is None:
+            with self._lock:
+                manager = self._managers.get(name)
+                if manager is None:
+                    manager = BitmapManager(self.isbn_data[name], self.start_isbn)
+                    self._managers[name] = manager
+        return manager
+
+    __getitem__ = get
+
+    def density(self, name=None, build=False):
+        """
+        Saved DensityPyramid of dataset `name` from `density_dir`, or None if
+        none was built for this snapshot. `build` builds the missing one,
+        which takes seconds per dataset, so it is for offline use only.
+        """
+        name = name or self.default
+        if name not in self._densities or (build and self._densities[name] is None):
+            with self._lock:
+                if name not in self._densities or (build and self._densities[name] is None):
+                    pyramid = None
+                    if self.density_dir:
+                        with span("load"):
+                            if build:
+                                pyramid = load_or_build(self.density_dir, name, self.isbn_data[name], self.source)
+                            else:
+                                pyramid = DensityPyramid.load(self.density_dir, name, self.source)
+                    self._densities[name] = pyramid
+        return self._densities[name]
+
+    def density_counts(self, name, scale, x0, y0, x1, y1):
+        """
+        Counts per cell of the 1:`scale` viewport [x0, x1) x [y0, y1), a cell
+        being a `scale` x `scale` block of the map: a slice of the saved level
+        if there is one, else counted from the streak index.
+        """
+        pyramid = self.density(name)
+        if pyramid is not None and scale in pyramid.levels:
+            return pyramid.query(scale, x0, y0, x1, y1)
+        manager = self.get(name)
+        with span("decode"):
+            return block_counts(manager.streak_starts, manager.streak_ends, scale, x0, y0, x1, y1,
+                                manager.lengths_before)
+
+    def sources(self, isbn):
+        """Membership bitmask of one ISBN-13 across all datasets."""
+        return int(self.sources_many([isbn])[0])
+
+    def sources_many(self, isbns):
+        """Membership bitmasks (uint32) of a batch of ISBN-13s, one indexed lookup per dataset."""
+        masks = np.zeros(len(isbns), dtype=np.uint32)
+        for bit, name in enumerate(self.names):
+            masks[self.get(name).is_available_many(isbns)] |= np.uint32(1 << bit)
+        return masks
+
+    def mask_names(self, mask):
+        """Dataset names whose bits are set in `mask`."""
+        return [name for bit, name in enumerate(self.names) if mask >> bit & 1]
@@ -0,0 +1,189 @@
+"""
+Build the full tile pyramid (1:1, 1:5, 1:25, 1:50 by default) in parallel.
+
+The 1:1 layers are rasterized once in this process and written as .npy files;
+coarser layers are block-downscaled from the finest layer they divide. Worker
+processes memory-map those files, so the decoded bitmap is shared through the
+OS page cache instead of being copied per worker. Tiles are written atomically
+and recorded with their checksum in a manifest, so reruns only render tiles
+that are missing, changed or corrupt.
+
+Usage:
+    python build_pyramid.py --output ../static/images/isbnmap --workers 8
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image
+
+import data_loader as D
+from rasterizer import TileRasterizer, GRID_WIDTH, GRID_HEIGHT, cut_tile, downscale_layer
+
+SCALES = (1, 5, 25, 50)
+TILE_WIDTH = 1000
+TILE_HEIGHT = 800
+LAYER_COLORS = {"others": [255, 0, 0], "md5": [0, 255, 0]}  # Painted in this order
+MANIFEST_NAME = "manifest.json"
+
+_layers = {}  # Per-worker memory-mapped layers, keyed by scale
+
+
+def source_signature(input_filename):
+    """Identify the input snapshot; a new snapshot invalidates every tile."""
+    stat = os.stat(input_filename)
+    return {"file": os.path.basename(input_filename), "size": stat.st_size, "mtime": int(stat.st_mtime)}
+
+
+def layer_path(layers_dir, name, scale):
+    return os.path.join(layers_dir, f"{name}_1_{scale}.npy")
+
+
+def atomic_write(path, data):
+    """Write `data` next to `path` and rename it into place, so readers never see a partial file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def sha256_file(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_manifest(output_dir, signature):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME), "r") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = {}
+    if manifest.get("source") != signature:
+        manifest = {"source": signature, "layers": False, "tiles": {}}
+    return manifest
+
+
+def save_manifest(output_dir, manifest):
+    atomic_write(os.path.join(output_dir, MANIFEST_NAME), json.dumps(manifest, indent=2).encode())
+
+
+def build_layers(input_filename, layers_dir, scales):
+    """Rasterize the 1:1 layers once, then downscale them for every other scale."""
+    os.makedirs(layers_dir, exist_ok=True)
+    isbn_data = D.load_isbn_data(input_filename)
+    others, md5 = TileRasterizer(isbn_data).layers(1)
+    built = {1: {"others": others[0], "md5": md5[0]}}
+    width = {1: GRID_WIDTH}
+
+    for scale in sorted(scales):
+        if scale in built:
+            continue
+        base = max(s for s in built if scale % s == 0)
+        factor = scale // base
+        print(f"Downscaling 1:{base} layers by {factor} for 1:{scale}...")
+        built[scale] = {name: downscale_layer(layer, factor, width[base]) for name, layer in built[base].items()}
+        width[scale] = -(-width[base] // factor)
+
+    for scale in scales:
+        for name, layer in built[scale].items():
+            tmp_path = layer_path(layers_dir, name, scale) + ".tmp.npy"
+            np.save(tmp_path, layer)
+            os.replace(tmp_path, layer_path(layers_dir, name, scale))
+    return width
+
+
+def tile_grid(scale):
+    """Number of tiles along x and y at 1:`scale`."""
+    width = -(-GRID_WIDTH // scale)
+    height = -(-GRID_HEIGHT // scale)
+    return -(-width // TILE_WIDTH), -(-height // TILE_HEIGHT)
+
+
+def _init_worker(layers_dir, scales):
+    for scale in scales:
+        _layers[scale] = [
+            (np.load(layer_path(layers_dir, name, scale), mmap_mode="r"), color)
+            for name, color in LAYER_COLORS.items()
+        ]
+
+
+def render_tile(scale, tile_x, tile_y, path):
+    """Render one tile from the shared layers, write it atomically and return its checksum."""
+    tile_data = np.zeros((TILE_HEIGHT, TILE_WIDTH, 3), dtype=np.uint8)
+    for layer, color in _layers[scale]:
+        tile_data[cut_tile(layer, tile_x, tile_y, TILE_WIDTH, TILE_HEIGHT)] = color
+
+    buffer = io.BytesIO()
+    Image.fromarray(tile_data, mode="RGB").save(buffer, format="PNG")
+    data = buffer.getvalue()
+    atomic_write(path, data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def pending_tiles(output_dir, manifest, scales):
+    """Tiles that are not in the manifest, missing on disk, or whose checksum does not match."""
+    for scale in scales:
+        tiles_x, tiles_y = tile_grid(scale)
+        os.makedirs(os.path.join(output_dir, f"1_{scale}"), exist_ok=True)
+        for tile_y in range(tiles_y):
+            for tile_x in range(tiles_x):
+                key = f"1_{scale}/tile_{tile_x}_{tile_y}.png"
+                path = os.path.join(output_dir, key)
+                entry = manifest["tiles"].get(key)
+                if entry and os.path.exists(path) and sha256_file(path) == entry["sha256"]:
+                    continue
+                yield key, scale, tile_x, tile_y, path
+
+
+def build_pyramid(input_filename=D.INPUT_FILENAME, output_dir="tiles", layers_dir="pyramid_layers",
+                  scales=SCALES, workers=None, checkpoint_every=50):
+    """Render every missing tile of the pyramid over a process pool."""
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir, source_signature(input_filename))
+
+    layers_ready = manifest["layers"] and all(
+        os.path.exists(layer_path(layers_dir, name, scale)) for scale in scales for name in LAYER_COLORS
+    )
+    if not layers_ready:
+        print("Rasterizing layers...")
+        build_layers(input_filename, layers_dir, scales)
+        manifest["layers"] = True
+        save_manifest(output_dir, manifest)
+
+    todo = list(pending_tiles(output_dir, manifest, scales))
+    print(f"{len(todo)} tiles to render")
+
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(layers_dir, scales)) as pool:
+        futures = {pool.submit(render_tile, scale, tile_x, tile_y, path): key for key, scale, tile_x, tile_y, path in todo}
+        for future in as_completed(futures):
+            manifest["tiles"][futures[future]] = {"sha256": future.result()}
+            done += 1
+            if done % checkpoint_every == 0:
+                save_manifest(output_dir, manifest)
+                print(f"{done}/{len(todo)} tiles done")
+
+    save_manifest(output_dir, manifest)
+    print(f"Pyramid complete: {done} tiles rendered")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the ISBN map tile pyramid.")
+    parser.add_argument("--input", default=D.INPUT_FILENAME, help="aa_isbn13_codes .benc.zst file")
+    parser.add_argument("--output", default="tiles", help="directory receiving 1_<scale>/tile_X_Y.png")
+    parser.add_argument("--layers-dir", default="pyramid_layers", help="directory for the shared .npy layers")
+    parser.add_argument("--scales", type=int, nargs="+", default=list(SCALES))
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    build_pyramid(args.input, args.output, args.layers_dir, tuple(args.scales), args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,16 @@
+import hashlib
+import json
+import os
+
+import numpy as np
 import requests
 import zstandard
 import bencodepy
 
+INPUT_FILENAME = "aa_isbn13_codes_20241204T185335Z.benc.zst"
+STORE_DIR = "isbn_store"
+STORE_MANIFEST = "manifest.json"
+
 def download_data(url, output_filename):
     headers = {
         "User-Agent": "Mozilla/5.0",
@@ -23,33 +32,124 @@ def decompress_data(input_filename):
         with decompressor.stream_reader(zst_file) as stream:
             return stream.read()
 
-def load_bitmap_manager(input_filename, start_isbn, dataset=b"gbooks"):
-    decompressed_data = decompress_data(input_filename)
-    isbn_data = bencodepy.decode(decompressed_data)
-    ## [b'cadal_ssno', b'cerlalc', b'duxiu_ssid', b'edsebk', b'gbooks', b'goodreads', b'ia', b'isbndb', b'isbngrp', b'libby', b'md5', b'nexusstc', b'nexusstc_download', b'oclc', b'ol', b'rgb', b'trantor']
-    # packed_isbns_binary = isbn_data[b'cadal_ssno']
-    # packed_isbns_binary = isbn_data[b'cerlalc']
-    # packed_isbns_binary = isbn_data[b'duxiu_ssid']
-    # packed_isbns_binary = isbn_data[b'edsebk']
-    packed_isbns_binary = isbn_data[dataset]
-    # packed_isbns_binary = isbn_data[b'goodreads']
-    # packed_isbns_binary = isbn_data[b'ia']
-    # packed_isbns_binary = isbn_data[b'isbndb']
-    # packed_isbns_binary = isbn_data[b'isbngrp']
-    # packed_isbns_binary = isbn_data[b'libby']
-    # packed_isbns_binary = isbn_data[b'md5']
-    # packed_isbns_binary = isbn_data[b'nexusstc']
-    # packed_isbns_binary = isbn_data[b'nexusstc_download']
-    # packed_isbns_binary = isbn_data[b'oclc']
-    # packed_isbns_binary = isbn_data[b'ol']
-    # packed_isbns_binary = isbn_data[b'rgb']
-    # packed_isbns_binary = isbn_data[b'trantor']
+def snapshot_identity(input_filename):
+    """Name, size and modification time of a snapshot file, as recorded in the store manifest."""
+    stat = os.stat(input_filename)
+    return {"source": os.path.basename(input_filename), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def file_sha256(filename, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_store_manifest(manifest, store_dir=STORE_DIR):
+    with open(os.path.join(store_dir, STORE_MANIFEST + ".tmp"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(os.path.join(store_dir, STORE_MANIFEST + ".tmp"), os.path.join(store_dir, STORE_MANIFEST))
+
+def convert_to_store(input_filename=INPUT_FILENAME, store_dir=STORE_DIR):
+    """
+    One-time conversion of the .benc.zst into an on-disk store: one raw
+    little-endian uint32 run array per dataset plus a JSON manifest.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    identity = snapshot_identity(input_filename)
+    sha256 = file_sha256(input_filename)
+    isbn_data = bencodepy.decode(decompress_data(input_filename))
+    datasets = {}
+    for prefix, packed_isbns_binary in isbn_data.items():
+        name = prefix.decode()
+        runs = np.frombuffer(packed_isbns_binary, dtype="<u4")
+        filename = f"{name}.u32"
+        runs.tofile(os.path.join(store_dir, filename + ".tmp"))
+        os.replace(os.path.join(store_dir, filename + ".tmp"), os.path.join(store_dir, filename))
+        datasets[name] = {
+            "file": filename,
+            "runs": len(runs),
+            "isbns": int(runs[0::2].sum(dtype=np.int64)),
+            "positions": int(runs.sum(dtype=np.int64)),
+        }
+        print(f"Stored {name}: {len(runs)} runs")
+
+    # The manifest goes last so a half-written store is never picked up. The
+    # run files are replaced, not rewritten, so processes still mapping the
+    # previous store keep reading the previous data
+    manifest = {**identity, "sha256": sha256, "datasets": datasets}
+    write_store_manifest(manifest, store_dir)
+    return manifest
+
+
+def read_store_manifest(store_dir=STORE_DIR):
+    try:
+        with open(os.path.join(store_dir, STORE_MANIFEST), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def store_is_current(manifest, input_filename, store_dir=STORE_DIR):
+    """
+    True if the store was converted from `input_filename` as it is now. The
+    name, size and mtime are compared first; when only those changed (a
+    touched or copied file), the content hash decides, and a match is
+    recorded so the file is not hashed again.
+    """
+    if manifest is None or "sha256" not in manifest:
+        return False
+    identity = snapshot_identity(input_filename)
+    if all(manifest.get(key) == value for key, value in identity.items()):
+        return True
+    if manifest["source"] != identity["source"] or file_sha256(input_filename) != manifest["sha256"]:
+        return False
+    manifest.update(identity)
+    write_store_manifest(manifest, store_dir)
+    return True
+
+def open_store(store_dir=STORE_DIR):
+    """Memory-map every dataset of the store; pages are shared between processes by the OS."""
+    manifest = read_store_manifest(store_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No ISBN store at {store_dir}")
+    return {
+        name: np.memmap(os.path.join(store_dir, entry["file"]), dtype="<u4", mode="r", shape=(entry["runs"],))
+        for name, entry in manifest["datasets"].items()
+    }
+
+
+def load_isbn_data(input_filename=INPUT_FILENAME, store_dir=STORE_DIR):
+    """
+    Run arrays of all datasets by name, memory-mapped from the store. The
+    store is built from `input_filename` on first use or when it changes,
+    including when a file of the same name is rewritten.
+    """
+    if not store_is_current(read_store_manifest(store_dir), input_filename, store_dir):
+        convert_to_store(input_filename, store_dir)
+    return open_store(store_dir)
+
+
+def load_bitmap_manager(input_filename, start_isbn, dataset="gbooks", store_dir=STORE_DIR):
+    ## ['cadal_ssno', 'cerlalc', 'duxiu_ssid', 'edsebk', 'gbooks', 'goodreads', 'ia', 'isbndb', 'isbngrp', 'libby', 'md5', 'nexusstc', 'nexusstc_download', 'oclc', 'ol', 'rgb', 'trantor']
+    if isinstance(dataset, bytes):
+        dataset = dataset.decode()
+    isbn_data = load_isbn_data(input_filename, store_dir)
     from bitmap_manager import BitmapManager
-    return BitmapManager(packed_isbns_binary, start_isbn)
+    return BitmapManager(isbn_data[dataset], start_isbn)
+
+
+def load_bitmap_registry(input_filename, start_isbn, default="gbooks", store_dir=STORE_DIR):
+    """All datasets behind one registry; each manager is built lazily from the shared store."""
+    isbn_data = load_isbn_data(input_filename, store_dir)
+    from bitmap_manager import BitmapRegistry
+    return BitmapRegistry(isbn_data, start_isbn, default,
+                          density_dir=os.path.join(store_dir, "density"),
+                          source=read_store_manifest(store_dir)["sha256"])
 
 
 
 if __name__ == "__main__":
     url = "https://software.annas-archive.li/AnnaArchivist/annas-archive/-/raw/main/isbn_images/aa_isbn13_codes_20241204T185335Z.benc.zst?inline=false"
-    output_filename = "aa_isbn13_codes_20241204T185335Z.benc.zst"
-    download_data(url, output_filename)
+    output_filename = INPUT_FILENAME
+    if download_data(url, output_filename):
+        convert_to_store(output_filename)
@@ -0,0 +1,227 @@
+"""
+Per-cell ISBN counts of a dataset at several zoom levels (/api/density).
+
+A cell of the 1:`scale` grid counts the `scale` x `scale` block of the 1:1
+map it covers (position = row * GRID_WIDTH + column), the geometry of the
+map tiles (rasterizer.downscale_layer), so every level is a spatial zoom of
+the map and of every other level. The legacy /api/global_view keeps its
+strips of consecutive positions (bucket_counts).
+
+Any viewport can be counted straight from the streak index (block_counts).
+Whole levels can be built offline and saved next to the ISBN store, where
+the server memory-maps them instead:
+
+    python density.py --scales 10 25 50 100
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from isbn_runs import decode_runs, streak_bounds, cumulative_lengths
+
+GRID_WIDTH = 50000
+GRID_HEIGHT = 40000
+SCALES = (5, 10, 25, 50, 100)  # 1:scale levels; 1:5 alone is 80M cells per dataset
+LAYOUT = "blocks"  # Saved with every pyramid; pyramids of another cell layout are rebuilt
+CHUNK = 1 << 22  # Bucket edges evaluated at a time by bucket_counts
+BAND_ROWS = 800  # Rows of the 1:1 map counted at a time while building a level
+
+
+def cumulative_counts(starts, ends, points, lengths_before=None):
+    """Number of member positions below each of `points` (vectorized)."""
+    if lengths_before is None:
+        lengths_before = cumulative_lengths(starts, ends)
+    points = np.asarray(points, dtype=np.int64)
+    index = np.searchsorted(ends, points, side="right")
+    counts = lengths_before[index]
+    inside = index < len(starts)
+    counts[inside] += np.maximum(points[inside] - starts[index[inside]], 0)
+    return counts
+
+
+def count_dtype(bucket):
+    """Smallest unsigned dtype that can hold a count of up to `bucket`."""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if bucket <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def bucket_counts(starts, ends, bucket, n_buckets):
+    """Members in each of `n_buckets` consecutive buckets of `bucket` positions."""
+    lengths_before = cumulative_lengths(starts, ends)
+    counts = np.empty(n_buckets, dtype=count_dtype(bucket))
+    for first in range(0, n_buckets, CHUNK):
+        last = min(first + CHUNK, n_buckets)
+        edges = np.arange(first, last + 1, dtype=np.int64) * bucket
+        counts[first:last] = np.diff(cumulative_counts(starts, ends, edges, lengths_before))
+    return counts
+
+
+class DensityPyramid:
+    """
+    Per-cell ISBN counts of one dataset at the levels it was built for. The
+    finest level is counted from the streak index in bands of rows
+    (block_counts); every coarser level it divides is summed from it in
+    `ratio` x `ratio` blocks with `np.add.reduceat`, over rows then columns.
+    Levels are (height, width) arrays, so any viewport is a slice.
+    """
+
+    def __init__(self, levels):
+        self.levels = levels
+
+    @classmethod
+    def build(cls, packed_isbns_binary, scales=SCALES):
+        starts, ends = streak_bounds(decode_runs(packed_isbns_binary))
+        lengths_before = cumulative_lengths(starts, ends)
+        levels = {}
+        for scale in sorted(scales):
+            height, width = cls.shape(scale)
+            base = max((s for s in levels if scale % s == 0), default=None)
+            if base is None:
+                band = max(BAND_ROWS // scale, 1)
+                levels[scale] = np.concatenate([
+                    block_counts(starts, ends, scale, 0, y, width, min(y + band, height), lengths_before)
+                    for y in range(0, height, band)
+                ])
+                continue
+            ratio = scale // base
+            fine = levels[base]
+            rows = np.add.reduceat(fine, np.arange(0, fine.shape[0], ratio), axis=0, dtype=count_dtype(scale * scale))
+            levels[scale] = np.add.reduceat(rows, np.arange(0, fine.shape[1], ratio), axis=1)
+        return cls(levels)
+
+    @staticmethod
+    def shape(scale):
+        """(height, width) of the 1:`scale` grid."""
+        return GRID_HEIGHT // scale, GRID_WIDTH // scale
+
+    def query(self, scale, x0, y0, x1, y1):
+        """Counts for cells [x0, x1) x [y0, y1) of the 1:`scale` level, clipped to the grid."""
+        if scale not in self.levels:
+            raise KeyError(f"No 1:{scale} level, available: {sorted(self.levels)}")
+        height, width = self.shape(scale)
+        x0, x1 = max(x0, 0), min(x1, width)
+        y0, y1 = max(y0, 0), min(y1, height)
+        return np.array(self.levels[scale][y0:max(y0, y1), x0:max(x0, x1)])
+
+    def save(self, directory, name, source):
+        """Write one .npy per level plus a manifest tying them to the store's source snapshot."""
+        os.makedirs(directory, exist_ok=True)
+        for scale, counts in self.levels.items():
+            path = os.path.join(directory, f"{name}_1_{scale}.npy")
+            np.save(path + ".tmp.npy", counts)
+            os.replace(path + ".tmp.npy", path)
+        # The manifest goes last and is renamed into place, so a half-written pyramid is never loaded
+        path = os.path.join(directory, f"{name}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump({"source": source, "layout": LAYOUT, "scales": sorted(self.levels)}, f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, directory, name, source):
+        """Memory-map a saved pyramid, or return None if it is missing or from another snapshot."""
+        try:
+            with open(os.path.join(directory, f"{name}.json"), "r") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        if manifest["source"] != source or manifest.get("layout") != LAYOUT:
+            return None
+        return cls({
+            scale: np.load(os.path.join(directory, f"{name}_1_{scale}.npy"), mmap_mode="r")
+            for scale in manifest["scales"]
+        })
+
+
+def load_or_build(directory, name, packed_isbns_binary, source, scales=SCALES):
+    """Cached pyramid for dataset `name`, rebuilt when the source snapshot changes."""
+    pyramid = DensityPyramid.load(directory, name, source)
+    if pyramid is None or not set(scales) <= set(pyramid.levels):
+        DensityPyramid.build(packed_isbns_binary, scales).save(directory, name, source)
+        pyramid = DensityPyramid.load(directory, name, source)
+    return pyramid
+
+
+def edge_block_counts(starts, ends, scale, x0, y0, x1, y1, lengths_before=None):
+    """
+    block_counts through the cumulative counts at the cell edges of every
+    1:1 row of the viewport: cheap for small viewports over dense data.
+    """
+    rows = np.arange(y0 * scale, y1 * scale, dtype=np.int64)[:, None] * GRID_WIDTH
+    edges = rows + np.arange(x0, x1 + 1, dtype=np.int64) * scale
+    counts = np.diff(cumulative_counts(starts, ends, edges.ravel(), lengths_before).reshape(edges.shape), axis=1)
+    return counts.reshape(y1 - y0, scale, x1 - x0).sum(axis=1)
+
+
+def streak_block_counts(starts, ends, scale, x0, y0, x1, y1):
+    """
+    block_counts from the streaks overlapping the viewport's rows: each
+    streak is split at row ends into pieces [u, v) of one row, and a piece
+    adds F(v) - F(u) to its block row, where F(t) covers cells below t // scale
+    fully and cell t // scale with t % scale positions. The full cells go in
+    as steps of a difference array, the partial ones as point counts.
+    """
+    lo, hi = y0 * scale * GRID_WIDTH, y1 * scale * GRID_WIDTH
+    first, last = np.searchsorted(ends, lo, side="right"), np.searchsorted(starts, hi)
+    a, b = np.maximum(starts[first:last], lo), np.minimum(ends[first:last], hi)
+
+    # Split every streak into one piece per row it crosses
+    first_rows = a // GRID_WIDTH
+    row_counts = (b - 1) // GRID_WIDTH - first_rows + 1
+    owner = np.repeat(np.arange(len(a)), row_counts)
+    rows = first_rows[owner] + np.arange(len(owner)) - np.repeat(np.cumsum(row_counts) - row_counts, row_counts)
+    u = np.clip(a[owner] - rows * GRID_WIDTH, x0 * scale, x1 * scale) - x0 * scale
+    v = np.clip(b[owner] - rows * GRID_WIDTH, x0 * scale, x1 * scale) - x0 * scale
+
+    # One spare column for pieces ending on the right edge of the viewport
+    n_cells = (y1 - y0) * (x1 - x0 + 1)
+    base = (rows // scale - y0) * (x1 - x0 + 1)
+    steps = (np.bincount(base + u // scale, minlength=n_cells) - np.bincount(base + v // scale, minlength=n_cells)) * scale
+    points = (np.bincount(base + v // scale, weights=v % scale, minlength=n_cells)
+              - np.bincount(base + u // scale, weights=u % scale, minlength=n_cells))
+    counts = np.cumsum(steps.reshape(y1 - y0, -1), axis=1) + np.rint(points).astype(np.int64).reshape(y1 - y0, -1)
+    return counts[:, :x1 - x0]
+
+
+def block_counts(starts, ends, scale, x0, y0, x1, y1, lengths_before=None):
+    """
+    Counts for cells [x0, x1) x [y0, y1) of the 1:`scale` grid (clipped to
+    it), a cell counting the `scale` x `scale` block of the 1:1 map it
+    covers. Takes whichever of the cell edges or the overlapping streaks is
+    fewer, so the cost follows the viewport and the data, not the level.
+    """
+    height, width = DensityPyramid.shape(scale)
+    x0, x1 = max(x0, 0), min(x1, width)
+    y0, y1 = max(y0, 0), min(max(y0, y1), height)
+    x1 = max(x0, x1)
+    n_edges = (y1 - y0) * scale * (x1 - x0 + 1)
+    n_streaks = (np.searchsorted(starts, y1 * scale * GRID_WIDTH)
+                 - np.searchsorted(ends, y0 * scale * GRID_WIDTH, side="right") + (y1 - y0) * scale)
+    if n_edges <= n_streaks:
+        counts = edge_block_counts(starts, ends, scale, x0, y0, x1, y1, lengths_before)
+    else:
+        counts = streak_block_counts(starts, ends, scale, x0, y0, x1, y1)
+    return counts.astype(count_dtype(scale * scale))
+
+
+def main():
+    import data_loader as D
+
+    parser = argparse.ArgumentParser(description="Build the density pyramids of every dataset next to the ISBN store.")
+    parser.add_argument("--input", default=D.INPUT_FILENAME, help="aa_isbn13_codes .benc.zst file")
+    parser.add_argument("--store", default=D.STORE_DIR, help="directory of the memory-mapped ISBN store")
+    parser.add_argument("--scales", type=int, nargs="+", default=list(SCALES))
+    args = parser.parse_args()
+
+    isbn_data = D.load_isbn_data(args.input, args.store)
+    source = D.read_store_manifest(args.store)["sha256"]
+    for name, runs in isbn_data.items():
+        load_or_build(os.path.join(args.store, "density"), name, runs, source, args.scales)
+        print(f"Built density levels {sorted(args.scales)} of {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,11 @@
 import data_loader as D
 from bitmap_manager import BitmapManager
+from rasterizer import TileRasterizer
+import stats
 import numpy as np
 import os
 import PIL.Image
 import PIL.ImageChops
-import struct
 
 
 import numpy as np
@@ -14,30 +15,20 @@ import os
 # let's create a several 1000x1000 clusters image from the bitmap data with given scale, numbers, and starting isbn
 ISBN_START = 978000000000  # Starting ISBN
 
-decompressed_data = D.decompress_data("aa_isbn13_codes_20241204T185335Z.benc.zst")
-isbn_data = D.bencodepy.decode(decompressed_data)
+# Memory-mapped run arrays by dataset name (built once from the .benc.zst)
+isbn_data = D.load_isbn_data("aa_isbn13_codes_20241204T185335Z.benc.zst")
 
 # print all data sets names
 print(isbn_data.keys())
 
+rasterizer = TileRasterizer(isbn_data)
+
 
 def calculate_titles():
     # read all the data set and put into a json file to indicate how many books are in each dataset, e.g. {"gbooks": 123456, "worldcat": 123456}
-    all_books = {}
-    for prefix, packed_isbns_binary in isbn_data.items():
-        packed_isbns_ints = struct.unpack(f'{len(packed_isbns_binary) // 4}I', packed_isbns_binary)
-        position = 0
-        isbn_streak = True
-        data_points_added = 0
-        for value in packed_isbns_ints:
-            if isbn_streak:
-                for _ in range(value):
-                    position += 1
-            else:
-                position += value
-            isbn_streak = not isbn_streak
-        all_books[prefix.decode()] = position
-        print(f"{prefix.decode()} has {position} books")
+    all_books = {name: s["count"] for name, s in stats.compute_stats(isbn_data).items() if name != "all"}
+    for prefix, count in all_books.items():
+        print(f"{prefix} has {count} books")
     return all_books
 # print(f"Total dataset positions: {len(bitmap_manager.packed_isbns_ints)}")
 
@@ -117,75 +108,10 @@ def generate_global_tile(tile_x=0, tile_y=0, tile_width=1000, tile_height=800, c
     enumerate all datasets and generate one images overlayed each other, all in red color but leaving "md5" green to process at last
     """
     os.makedirs(cache_dir, exist_ok=True)
-    
-    tile_data = np.zeros((tile_height, tile_width, 3), dtype=np.uint8)
-
-    for prefix, packed_isbns_binary in isbn_data.items():
-        if prefix == b'md5':
-            continue
-        
-        start_row = tile_y * tile_height
-        end_row = start_row + tile_height
-        start_col = tile_x * tile_width
-        end_col = start_col + tile_width
-
-        packed_isbns_ints = struct.unpack(f'{len(packed_isbns_binary) // 4}I', packed_isbns_binary)
-        position = 0
-        isbn_streak = True
-        data_points_added = 0
-
-        for value in packed_isbns_ints:
-            if isbn_streak:
-                for _ in range(value):
-                    global_row = position // 50000
-                    global_col = position % 50000
-
-                    if start_row <= global_row < end_row and start_col <= global_col < end_col:
-                        local_row = global_row - start_row
-                        local_col = global_col - start_col
-                        tile_data[local_row, local_col] = [255, 0, 0]
-                        data_points_added += 1
-
-                    position += 1
-            else:
-                position += value
-
-            isbn_streak = not isbn_streak
-
-        print(f"{prefix} added to tile ({tile_x}, {tile_y}): {data_points_added}")
-
-    # now it's time to deal with md5 with same logic
-    prefix = b'md5'
-    packed_isbns_binary = isbn_data[prefix]
-    start_row = tile_y * tile_height
-    end_row = start_row + tile_height
-    start_col = tile_x * tile_width
-    end_col = start_col + tile_width
-
-    packed_isbns_ints = struct.unpack(f'{len(packed_isbns_binary) // 4}I', packed_isbns_binary)
-    position = 0
-    isbn_streak = True
-    data_points_added = 0
-
-    for value in packed_isbns_ints:
-        if isbn_streak:
-            for _ in range(value):
-                global_row = position // 50000
-                global_col = position % 50000
-
-                if start_row <= global_row < end_row and start_col <= global_col < end_col:
-                    local_row = global_row - start_row
-                    local_col = global_col - start_col
-                    tile_data[local_row, local_col] = [0, 255, 0]
-                    data_points_added += 1
-
-                position += 1
-        else:
-            position += value
-
-        isbn_streak = not isbn_streak
-
-    print(f"Data points of md5 added to tile ({tile_x}, {tile_y}): {data_points_added}")
+
+    # Layers are decoded once on the first tile and sliced for every other one
+    tile_data = rasterizer.render(tile_x, tile_y, tile_width, tile_height)
+    print(f"Data points of md5 added to tile ({tile_x}, {tile_y}): {np.count_nonzero(tile_data[:, :, 1])}")
 
     # Save the tile as an image
     img = Image.fromarray(tile_data, mode="RGB")
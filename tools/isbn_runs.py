@@ -0,0 +1,200 @@
+import numpy as np
+
+from metrics import span
+
+
+def decode_runs(packed_isbns_binary):
+    """Decode the packed streak/gap integers into a little-endian uint32 array."""
+    if isinstance(packed_isbns_binary, np.ndarray):
+        return packed_isbns_binary
+    return np.frombuffer(packed_isbns_binary, dtype="<u4", count=len(packed_isbns_binary) // 4)
+
+
+def streak_bounds(runs):
+    """
+    Build the cumulative position index over the runs.
+
+    `runs` alternates `isbn_streak` and `gap_size`, starting with a streak.
+    Returns two int64 arrays holding the first position of every streak and
+    the position just after it, so streak `i` covers [starts[i], ends[i]).
+    """
+    boundaries = np.zeros(len(runs) + 1, dtype=np.int64)
+    np.cumsum(runs, out=boundaries[1:])
+    starts = boundaries[0:len(runs):2]
+    ends = boundaries[1::2]
+    # Drop empty streaks so every interval in the index is non-empty
+    keep = ends > starts
+    return np.ascontiguousarray(starts[keep]), np.ascontiguousarray(ends[keep])
+
+
+def merge_intervals(starts, ends):
+    """
+    Merge sorted-by-start [start, end) intervals that overlap or touch, e.g.
+    streaks of several datasets or streaks mapped onto a coarser scale.
+    """
+    if len(starts) == 0:
+        return starts, ends
+    reach = np.maximum.accumulate(ends)
+    new_group = np.empty(len(starts), dtype=bool)
+    new_group[0] = True
+    new_group[1:] = starts[1:] > reach[:-1]
+    group_starts = np.flatnonzero(new_group)
+    group_ends = np.append(group_starts[1:], len(starts)) - 1
+    return starts[group_starts], reach[group_ends]
+
+
+def union_bounds(bounds):
+    """Union of several (starts, ends) streak indexes as one merged index."""
+    starts = np.concatenate([b[0] for b in bounds]) if bounds else np.zeros(0, dtype=np.int64)
+    ends = np.concatenate([b[1] for b in bounds]) if bounds else np.zeros(0, dtype=np.int64)
+    order = np.argsort(starts, kind="stable")
+    return merge_intervals(starts[order], ends[order])
+
+
+def contains(starts, ends, positions):
+    """Vectorized membership test of `positions` against the streak index."""
+    positions = np.asarray(positions, dtype=np.int64)
+    with span("seek"):
+        index = np.searchsorted(ends, positions, side="right")
+        found = index < len(starts)
+        found[found] = starts[index[found]] <= positions[found]
+    return found
+
+
+def occupancy(starts, ends, start, n):
+    """
+    Expand the window [start, start + n) into a boolean occupancy array.
+    Seeks to the first streak of the window through the index and fills all
+    overlapping streaks at once with a +1/-1 difference array.
+    """
+    with span("seek"):
+        first = np.searchsorted(ends, start, side="right")
+        last = np.searchsorted(starts, start + n, side="left")
+    with span("decode"):
+        marks = np.zeros(n + 1, dtype=np.int8)
+        # Streaks are disjoint and non-empty, so no index repeats within either side
+        marks[np.clip(starts[first:last] - start, 0, n)] += 1
+        marks[np.clip(ends[first:last] - start, 0, n)] -= 1
+        return np.cumsum(marks[:n], dtype=np.int8).astype(bool)
+
+
+def check_digits13(isbns12):
+    """Vectorized ISBN-13 check digits for an array of 12-digit integers."""
+    isbns12 = np.asarray(isbns12, dtype=np.int64)
+    total = np.zeros(isbns12.shape, dtype=np.int64)
+    remaining = isbns12.copy()
+    # Digits from the right alternate weight 3, 1, 3, ...
+    for weight in (3, 1) * 6:
+        total += weight * (remaining % 10)
+        remaining //= 10
+    return (10 - total % 10) % 10
+
+
+def isbn13_numbers(isbns12):
+    """Append the check digit to an array of 12-digit integers."""
+    isbns12 = np.asarray(isbns12, dtype=np.int64)
+    with span("check_digits"):
+        return isbns12 * 10 + check_digits13(isbns12)
+
+
+def cumulative_lengths(starts, ends):
+    """Member counts before each streak, with the total as the last element."""
+    return np.concatenate(([0], np.cumsum(ends - starts)))
+
+
+def member_rank(starts, ends, position, lengths_before=None):
+    """Number of member positions strictly below `position`."""
+    if lengths_before is None:
+        lengths_before = cumulative_lengths(starts, ends)
+    index = np.searchsorted(ends, position, side="right")
+    partial = max(0, min(position, int(ends[index])) - int(starts[index])) if index < len(starts) else 0
+    return int(lengths_before[index]) + partial
+
+
+def member_positions(starts, ends, first, n, lengths_before=None):
+    """Positions of the members ranked [first, first + n) in ascending order."""
+    if lengths_before is None:
+        lengths_before = cumulative_lengths(starts, ends)
+    ranks = np.arange(first, min(first + n, int(lengths_before[-1])), dtype=np.int64)
+    index = np.searchsorted(lengths_before, ranks, side="right") - 1
+    return starts[index] + (ranks - lengths_before[index])
+
+
+def rect_occupancy(starts, ends, x0, y0, w, h, width):
+    """
+    Occupancy of the rectangle [x0, x0 + w) x [y0, y0 + h) of a grid laid out
+    `width` positions per row, as an (h, w) bool array. Only streaks inside
+    the band of rows are touched, each split into its per-row pieces.
+    """
+    band_start = y0 * width
+    band_end = (y0 + h) * width
+    with span("seek"):
+        first = np.searchsorted(ends, band_start, side="right")
+        last = np.searchsorted(starts, band_end, side="left")
+    with span("decode"):
+        return _fill_rect(starts[first:last], ends[first:last], band_start, band_end, x0, w, h, width)
+
+
+def _fill_rect(starts, ends, band_start, band_end, x0, w, h, width):
+    """The decode step of rect_occupancy, over the streaks overlapping the band."""
+    piece_starts = np.clip(starts, band_start, band_end) - band_start
+    piece_ends = np.clip(ends, band_start, band_end) - band_start
+
+    # Split every streak into one piece per row it crosses
+    first_rows = piece_starts // width
+    row_counts = (piece_ends - 1) // width - first_rows + 1
+    owner = np.repeat(np.arange(len(piece_starts)), row_counts)
+    offsets = np.arange(len(owner)) - np.repeat(np.cumsum(row_counts) - row_counts, row_counts)
+    rows = first_rows[owner] + offsets
+    cols_start = np.clip(np.maximum(piece_starts[owner] - rows * width, 0), x0, x0 + w) - x0
+    cols_end = np.clip(np.minimum(piece_ends[owner] - rows * width, width), x0, x0 + w) - x0
+    keep = cols_end > cols_start
+
+    # Pieces in a row are disjoint, so no index repeats within either side
+    marks = np.zeros((h, w + 1), dtype=np.int8)
+    marks[rows[keep], cols_start[keep]] += 1
+    marks[rows[keep], cols_end[keep]] -= 1
+    return np.cumsum(marks[:, :w], axis=1, dtype=np.int8).astype(bool)
+
+
+ISBN_JUNK = str.maketrans("", "", "- \t\r")  # Separators dropped from ISBNs before validation
+
+
+def normalize_isbns(values):
+    """
+    Vectorized validation of ISBN-10/13 strings (hyphens and spaces allowed).
+    Returns the ISBN-13 of every value as an int64 array, 0 where invalid,
+    and the boolean validity mask.
+    """
+    # Clean all values in one string operation; one spare byte, so longer
+    # values do not get truncated into 13 valid-looking characters. Non-ASCII
+    # characters become "?", which makes their value invalid
+    values = [str(value) for value in values]
+    cleaned = "\n".join(values).translate(ISBN_JUNK).upper().encode("ascii", errors="replace").split(b"\n") if values else []
+    if len(cleaned) != len(values):  # Values with embedded newlines
+        cleaned = [value.translate(ISBN_JUNK).upper().encode("ascii", errors="replace") for value in values]
+    cleaned = np.array(cleaned, dtype="S14")
+    n = len(cleaned)
+    lengths = np.char.str_len(cleaned) if n else np.zeros(0, dtype=np.int64)
+    chars = cleaned.view(np.uint8).reshape(n, 14)[:, :13]
+    digits = chars.astype(np.int64) - ord("0")
+    is_digit = (digits >= 0) & (digits <= 9)
+    isbns = np.zeros(n, dtype=np.int64)
+    valid = np.zeros(n, dtype=bool)
+
+    # ISBN-13: 978/979 prefix and digits weighted 1, 3, 1, ... summing to a multiple of 10
+    rows = np.flatnonzero((lengths == 13) & is_digit.all(axis=1))
+    numbers = digits[rows] @ (10 ** np.arange(12, -1, -1, dtype=np.int64))
+    checksum = digits[rows] @ np.tile([1, 3], 7)[:13]
+    ok = (checksum % 10 == 0) & ((numbers // 10 ** 10 == 978) | (numbers // 10 ** 10 == 979))
+    isbns[rows[ok]], valid[rows[ok]] = numbers[ok], True
+
+    # ISBN-10: nine digits plus a digit or X, weighted 10 down to 1 summing to a multiple of 11
+    rows = np.flatnonzero((lengths == 10) & is_digit[:, :9].all(axis=1)
+                          & (is_digit[:, 9] | (chars[:, 9] == ord("X"))))
+    last = np.where(chars[rows, 9] == ord("X"), 10, digits[rows, 9])
+    checksum = digits[rows, :9] @ np.arange(10, 1, -1) + last
+    ok = checksum % 11 == 0
+    isbns12 = 978000000000 + digits[rows[ok], :9] @ (10 ** np.arange(8, -1, -1, dtype=np.int64))
+    isbns[rows[ok]], valid[rows[ok]] = isbn13_numbers(isbns12), True
+    return isbns, valid
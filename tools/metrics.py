@@ -0,0 +1,216 @@
+"""
+Request metrics for the Flask app, in the Prometheus text format.
+
+`instrument(app)` records the latency and response size of every request by
+route, and serves everything registered here at /metrics. Code on the hot
+paths marks its phases with `span(name)`: within a request each span is added
+to a latency histogram by name and, when the client opts in (`X-Server-Timing:
+1` or the SERVER_TIMING config), summed into the request's `Server-Timing`
+header. Outside requests (the offline tools) spans cost next to nothing.
+No dependency beyond Flask; the exposition format is written by hand.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = tuple(256 * 4 ** k for k in range(10))  # 256 B to 64 MB
+SERVER_TIMING_HEADER = "X-Server-Timing"  # Request header opting in to the Server-Timing response header
+TEXT_MIMETYPE = "text/plain; version=0.0.4"
+
+_route = ContextVar("route", default=None)  # Route template of the current request
+_spans = ContextVar("spans", default=None)  # {name: [count, seconds]} of the current request
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+def _format_value(value):
+    return "+Inf" if value == math.inf else repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter per label combination."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self.labels, key, value) for key, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label combination, plus the sum and count of observations."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0]
+            counts = entry[0]
+            for k, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[k] += 1
+            entry[1] += value
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((self.name + "_bucket", self.labels + ("le",), key + (_format_value(bound),), count))
+                samples.append((self.name + "_sum", self.labels, key, total))
+                samples.append((self.name + "_count", self.labels, key, counts[-1]))  # The +Inf bucket
+        return samples
+
+
+class Gauge:
+    """Value read at scrape time from `function()`, which returns a number or {label values: number}."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, function, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.function = function
+
+    def samples(self):
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, self.labels, key, value) for key, value in sorted(values.items())]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, label_names, label_values, value in metric.samples():
+                lines.append(f"{name}{_format_labels(label_names, label_values)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "Time from routing to the end of the view, by route.",
+    labels=("route", "method", "status")))
+RESPONSE_SIZE = REGISTRY.register(Histogram(
+    "http_response_size_bytes", "Size of non-streamed response bodies, by route.",
+    labels=("route",), buckets=SIZE_BUCKETS))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    "cache_requests_total", "Lookups of the response caches, by route, cache and result.",
+    labels=("route", "cache", "result")))
+SPAN_LATENCY = REGISTRY.register(Histogram(
+    "span_duration_seconds", "Time spent in the instrumented phases (seek, decode, check_digits, serialize...).",
+    labels=("span",)))
+
+
+@contextmanager
+def span(name):
+    """Time the enclosed block as phase `name` of the current request; a no-op outside requests."""
+    spans = _spans.get()
+    if spans is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        SPAN_LATENCY.observe(elapsed, span=name)
+        entry = spans.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+
+
+def cache_result(cache, hit):
+    """Count one lookup of `cache` for the current route."""
+    CACHE_REQUESTS.inc(route=_route.get() or "", cache=cache, result="hit" if hit else "miss")
+
+
+def server_timing(spans, total):
+    """Server-Timing header value: the summed duration of every span, in milliseconds, then the total."""
+    metrics = [f"{name};dur={seconds * 1000:.3f}" for name, (_, seconds) in spans.items()]
+    metrics.append(f"total;dur={total * 1000:.3f}")
+    return ", ".join(metrics)
+
+
+def instrument(app, registry=REGISTRY):
+    """Record every request of `app`, time its JSON serialization and serve `registry` at /metrics."""
+    from flask import Response, g, request
+    from flask.json.provider import DefaultJSONProvider
+
+    class TimedJSONProvider(DefaultJSONProvider):
+        def dumps(self, obj, **kwargs):
+            with span("serialize"):
+                return super().dumps(obj, **kwargs)
+
+    app.json = TimedJSONProvider(app)
+    app.config.setdefault("SERVER_TIMING", False)
+
+    @app.before_request
+    def start_request():
+        g.metrics_started = time.perf_counter()
+        g.metrics_route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        g.metrics_tokens = (_route.set(g.metrics_route), _spans.set({}))
+
+    @app.after_request
+    def finish_request(response):
+        started = g.pop("metrics_started", None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        route = g.pop("metrics_route")
+        REQUEST_LATENCY.observe(elapsed, route=route, method=request.method, status=str(response.status_code))
+        if not response.is_streamed:
+            RESPONSE_SIZE.observe(response.calculate_content_length() or 0, route=route)
+        if app.config["SERVER_TIMING"] or request.headers.get(SERVER_TIMING_HEADER) == "1":
+            response.headers["Server-Timing"] = server_timing(_spans.get() or {}, elapsed)
+        return response
+
+    @app.teardown_request
+    def reset_request(exc=None):
+        tokens = g.pop("metrics_tokens", None)
+        if tokens:
+            _route.reset(tokens[0])
+            _spans.reset(tokens[1])
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(registry.render(), mimetype=TEXT_MIMETYPE)
+
+    return app
@@ -1,17 +1,19 @@
-import sqlite3
 import json
-import zstandard as zstd
+import re
 import isbnlib
 import logging
 from tqdm import tqdm
 
+import db
+from seekable_zst import scan_file
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-DB_FILE = "rare_books.db"
+DB_FILE = db.DB_FILE
 ZST_FILE = "annas_archive_meta__aacid__worldcat__20241230T203056Z--20241230T203056Z.jsonl.seekable.zst"
 
 
@@ -32,85 +34,81 @@ def normalize_isbn(isbn):
         return None
     return None
 
-BATCH_SIZE = 5000  # Adjust based on memory and performance requirements
+OCLC_NUMBERS = re.compile(rb'"(?:oclc_number|oclcNumber)"\s*:\s*"?0*(\d+)')  # Cheap pre-filter on the raw line
+
+_pending = set()  # OCLC numbers still waiting for an ISBN; loaded once, inherited by the forked workers
+
+
+def load_pending(db_file=DB_FILE):
+    """Load the OCLC numbers without an ISBN into the module-level set, before the scan forks its workers."""
+    global _pending
+    conn = db.connect(db_file)
+    try:
+        _pending = {row[0] for row in conn.execute("SELECT oclc_number FROM oclc_holdings WHERE isbn_13 IS NULL")}
+    finally:
+        conn.close()
+
 
-def process_zst_file(number_of_lines=None):
-    """Scan the .zst file and match ISBNs to OCLC records."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    line_counter = 0  
-    update_batch = []  
+def record_isbn(record):
+    """(isbn_13, title) of a parsed worldcat record; the first valid ISBN wins, None if there is none."""
+    record_data = record.get("metadata", {}).get("record", {})
+    title = record_data.get("title", "Unknown Title")
+    for isbn in record_data.get("isbns") or []:
+        isbn_13 = normalize_isbn(isbn)
+        if isbn_13 is not None:
+            return isbn_13, title
+    return None, title
+
+
+def match_line(line):
+    """
+    Return (oclc_number, isbn_13, title) if the line is a pending OCLC record with a valid ISBN, else None.
+    The OCLC number is looked up in the pending set on the raw bytes first, so only matches are parsed as JSON.
+    """
+    if not any(number.decode() in _pending for number in OCLC_NUMBERS.findall(line)):
+        return None
+    try:
+        record = json.loads(line)
+    except json.JSONDecodeError:
+        logging.warning("Skipping invalid JSON line.")
+        return None
+    metadata = record.get("metadata", {})
+    oclc_number = metadata.get("oclc_number") or metadata.get("record", {}).get("oclcNumber")
+    if not oclc_number or normalize_oclc(oclc_number) not in _pending:
+        return None
+    isbn_13, title = record_isbn(record)
+    if isbn_13 is None:
+        return None
+    return normalize_oclc(oclc_number), isbn_13, title
+
+
+def process_zst_file(number_of_lines=None, workers=None):
+    """
+    Scan the .zst file and match ISBNs to OCLC records.
+
+    The pending OCLC numbers are loaded once into a set in this process and
+    shared with the forked workers, the file is scanned in parallel by frame
+    ranges (see seekable_zst.scan_file), and matches are applied with one
+    UPDATE ... FROM join (see db.update_isbns). The first match wins twice:
+    the first valid ISBN of a record, and the first record of an OCLC number
+    in file order. With `number_of_lines`, no new jobs are started once that
+    many lines were read.
+    """
+    load_pending(DB_FILE)
+    conn = db.connect(DB_FILE)
+    counts = {"lines": 0, "matches": 0}
+
+    def matches():
+        with tqdm(desc="Scanning ISBNs", unit="line") as pbar:
+            for batch, count in scan_file(ZST_FILE, match_line, workers, max_records=number_of_lines):
+                counts["lines"] += count
+                counts["matches"] += len(batch)
+                pbar.update(count)
+                yield batch
 
     try:
-        with open(ZST_FILE, 'rb') as zst_file:
-            decompressor = zstd.ZstdDecompressor()
-            with decompressor.stream_reader(zst_file) as stream, tqdm(desc="Scanning ISBNs", unit="line") as pbar:
-                buffer = b""
-
-                while True:
-                    chunk = stream.read(65536)
-                    if not chunk:
-                        break
-
-                    buffer += chunk
-                    while b'\n' in buffer:
-                        line, buffer = buffer.split(b'\n', 1)
-                        if not line.strip():
-                            continue
-
-                        try:
-                            record = json.loads(line)
-                            metadata = record.get("metadata", {})
-                            record_data = metadata.get("record", {})
-
-                            oclc_number = metadata.get("oclc_number") or record_data.get("oclcNumber")
-                            isbns = record_data.get("isbns", [])
-                            title = record_data.get("title", "Unknown Title")
-
-                            if oclc_number and isbns:
-                                for isbn in isbns:
-                                    normalized_isbn = normalize_isbn(isbn)
-                                    if normalized_isbn:
-                                        normalized_oclc = normalize_oclc(oclc_number)
-                                        # Check if OCLC exists and needs update
-                                        cursor.execute("""
-                                            SELECT COUNT(*) FROM oclc_holdings 
-                                            WHERE oclc_number = ? AND isbn_13 IS NULL
-                                        """, (normalized_oclc,))
-                                        exists = cursor.fetchone()[0]
-
-                                        if exists:
-                                            update_batch.append((normalized_isbn, title, normalized_oclc))
-
-                            line_counter += 1
-                            pbar.update(1)
-
-                            # Commit in batches
-                            if len(update_batch) >= BATCH_SIZE:
-                                cursor.executemany("""
-                                    UPDATE oclc_holdings 
-                                    SET isbn_13 = ?, title = ? 
-                                    WHERE oclc_number = ?
-                                """, update_batch)
-                                conn.commit()
-                                update_batch.clear()
-                                logging.info(f"Committed {BATCH_SIZE} records")
-
-                            if number_of_lines and line_counter >= number_of_lines:
-                                break
-
-                        except json.JSONDecodeError:
-                            logging.warning("Skipping invalid JSON line.")
-
-                # Final commit for remaining batch
-                if update_batch:
-                    cursor.executemany("""
-                        UPDATE oclc_holdings 
-                        SET isbn_13 = ?, title = ? 
-                        WHERE oclc_number = ?
-                    """, update_batch)
-                    conn.commit()
-                    logging.info(f"Final batch committed with {len(update_batch)} records")
+        updated = db.update_isbns(conn, matches())
+        logging.info(f"Matched {counts['matches']} ISBNs in {counts['lines']} lines, updated {updated} records")
 
     except Exception as e:
         logging.error(f"Error processing file: {str(e)}")
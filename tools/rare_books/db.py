@@ -0,0 +1,239 @@
+"""
+SQLite access for the rare-books pipeline.
+
+Every tool opens `rare_books.db` through `connect`, which applies the
+pragmas below. Bulk loads run inside `bulk_load`, which drops the secondary
+indexes first and rebuilds them (and the planner statistics) once at the end,
+which is much cheaper than maintaining them row by row. The full-text index
+over titles is rebuilt at the same point.
+
+Usage:
+    python db.py --benchmark 2000000    # compare against a default connection
+    python db.py --search               # (re)build the title search index only
+"""
+import argparse
+import logging
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+
+DB_FILE = "rare_books.db"
+
+PRAGMAS = {
+    "journal_mode": "WAL",  # Readers (tile export, app) do not block the writer
+    "synchronous": "NORMAL",  # Safe with WAL; fsync only at checkpoints
+    "cache_size": -256 * 1024,  # 256MB page cache (negative means KiB)
+    "mmap_size": 1 << 30,  # Read pages through a 1GB memory map
+    "temp_store": "MEMORY",  # Temp tables and sort spills stay in memory
+}
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS oclc_holdings (
+        oclc_number TEXT PRIMARY KEY,
+        total_holding_count INTEGER,
+        isbn_13 INTEGER,
+        title TEXT
+    )
+"""
+
+# Serves the keyset of the tile export (isbn_13, oclc_number), filters on holdings
+# inside the index, and covers the pending lookup of amend_isbn (isbn_13 IS NULL).
+# Titles stay out of the key: they would copy every title into the index, and
+# the export only reads them for the rows that pass the filter
+INDEXES = {
+    "idx_holdings_isbn": "oclc_holdings (isbn_13, oclc_number, total_holding_count)",
+}
+
+# Title search: an external-content FTS5 index, so titles are not stored twice.
+# It has no triggers, so it is rebuilt after every load; prefix='2 3' keeps
+# short prefix queries ("voc*") off the full term list.
+SEARCH_TABLE = "titles_fts"
+SEARCH_SCHEMA = f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+        title,
+        content='oclc_holdings',
+        content_rowid='rowid',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+"""
+
+
+def connect(db_file=DB_FILE, timeout=10):
+    """Open the database with the pipeline pragmas applied."""
+    conn = sqlite3.connect(db_file, timeout=timeout)
+    for name, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+def setup_schema(conn):
+    conn.execute(SCHEMA)
+    conn.commit()
+
+
+def create_indexes(conn):
+    for name, definition in INDEXES.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+    conn.execute("ANALYZE")
+    conn.commit()
+    build_search_index(conn)
+
+
+def build_search_index(conn):
+    """(Re)build the title search index from the current table contents."""
+    try:
+        conn.execute(SEARCH_SCHEMA)
+    except sqlite3.OperationalError as e:
+        logging.warning(f"Title search index not built: {e}")  # SQLite compiled without FTS5
+        return
+    logging.info("Building title search index...")
+    conn.execute(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')")
+    conn.execute(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('optimize')")
+    conn.commit()
+
+
+def drop_indexes(conn):
+    for name in INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+    conn.commit()
+
+
+@contextmanager
+def bulk_load(conn):
+    """Drop the secondary indexes for the duration of a bulk load and rebuild them afterwards."""
+    drop_indexes(conn)
+    try:
+        yield conn
+    finally:
+        conn.commit()
+        logging.info("Building indexes...")
+        create_indexes(conn)
+
+
+def upsert_holdings(conn, records):
+    """Insert or update a batch of (oclc_number, total_holding_count) records."""
+    conn.executemany("""
+        INSERT OR REPLACE INTO oclc_holdings (oclc_number, total_holding_count)
+        VALUES (?, ?)
+    """, records)
+
+
+def upsert_amended(conn, records):
+    """Insert or update a batch of (oclc_number, total_holding_count, isbn_13, title) records."""
+    conn.executemany("""
+        INSERT OR REPLACE INTO oclc_holdings (oclc_number, total_holding_count, isbn_13, title)
+        VALUES (?, ?, ?, ?)
+    """, records)
+
+
+def update_isbns(conn, matches):
+    """
+    Fill in the ISBN and title of OCLC records that have none, from
+    (oclc_number, isbn_13, title) matches; the first match per OCLC number
+    in the order given wins (INSERT OR IGNORE), like the first valid ISBN
+    within a record (amend_isbn.record_isbn). Matches are staged in a temp
+    table and applied with one join.
+    Returns the number of updated records.
+    """
+    conn.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS isbn_matches (
+            oclc_number TEXT PRIMARY KEY,
+            isbn_13 INTEGER,
+            title TEXT
+        )
+    """)
+    for batch in matches:
+        conn.executemany("INSERT OR IGNORE INTO isbn_matches VALUES (?, ?, ?)", batch)
+    # The index keys on isbn_13, so rebuild it once rather than per updated row
+    with bulk_load(conn):
+        cursor = conn.execute("""
+            UPDATE oclc_holdings
+            SET isbn_13 = m.isbn_13, title = m.title
+            FROM isbn_matches AS m
+            WHERE oclc_holdings.oclc_number = m.oclc_number AND oclc_holdings.isbn_13 IS NULL
+        """)
+        updated = cursor.rowcount
+    conn.execute("DROP TABLE isbn_matches")
+    conn.commit()
+    return updated
+
+
+def synthetic_rows(n_rows, batch_size=100000, seed=0):
+    """Batches of random (oclc_number, total_holding_count, isbn_13, title) rows; about half have an ISBN."""
+    rng = random.Random(seed)
+    for first in range(0, n_rows, batch_size):
+        yield [
+            (str(k), rng.randrange(1, 11),
+             (978000000000 + rng.randrange(2000000000)) * 10 if rng.random() < 0.5 else None, f"Title {k}")
+            for k in range(first, min(first + batch_size, n_rows))
+        ]
+
+
+def benchmark(n_rows):
+    """Time loading `n_rows` synthetic rows and the tile export query, default connection vs `connect`."""
+    export = """
+        SELECT isbn_13, oclc_number, title, total_holding_count
+        FROM oclc_holdings
+        WHERE isbn_13 IS NOT NULL AND total_holding_count < ? AND (isbn_13, oclc_number) > (?, ?)
+        ORDER BY isbn_13 ASC, oclc_number ASC
+        LIMIT ?
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for label, tuned in (("default", False), ("tuned", True)):
+            path = os.path.join(directory, f"{label}.db")
+            conn = connect(path) if tuned else sqlite3.connect(path)
+            conn.execute(SCHEMA)
+
+            started = time.perf_counter()
+            if tuned:
+                with bulk_load(conn):
+                    for batch in synthetic_rows(n_rows):
+                        upsert_amended(conn, batch)
+                        conn.commit()
+            else:
+                # The previous setup: no secondary index, a commit every million rows
+                for k, batch in enumerate(synthetic_rows(n_rows)):
+                    upsert_amended(conn, batch)
+                    if (k + 1) * len(batch) % 1000000 == 0:
+                        conn.commit()
+                conn.commit()
+            load = time.perf_counter() - started
+
+            started = time.perf_counter()
+            last, exported = (-1, ""), 0
+            while True:
+                rows = conn.execute(export, (4, *last, 10000)).fetchall()
+                if not rows:
+                    break
+                last, exported = rows[-1][:2], exported + len(rows)
+            query = time.perf_counter() - started
+            conn.close()
+
+            results[label] = {"load_s": round(load, 2), "export_s": round(query, 2), "exported": exported,
+                              "rows_per_s": round(n_rows / load)}
+            logging.info(f"{label}: {results[label]}")
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Rare-books database helpers.")
+    parser.add_argument("--benchmark", type=int, metavar="ROWS", help="run the synthetic benchmark")
+    parser.add_argument("--index", action="store_true", help="(re)build the indexes of DB_FILE")
+    parser.add_argument("--search", action="store_true", help="(re)build the title search index of DB_FILE")
+    args = parser.parse_args()
+    if args.benchmark:
+        print(benchmark(args.benchmark))
+    elif args.index or args.search:
+        conn = connect()
+        if args.index:
+            drop_indexes(conn)  # Also replaces an index built with an older definition
+            create_indexes(conn)
+        else:
+            build_search_index(conn)
+        conn.close()
@@ -1,9 +1,14 @@
-import zstandard as zstd
 import json
 import logging
-import sqlite3
+import re
+import sys
+import time
 from tqdm import tqdm
 
+import db
+from amend_isbn import record_isbn
+from seekable_zst import scan_file
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -11,9 +16,9 @@ logging.basicConfig(
 )
 
 # Database configuration
-DB_FILE = "rare_books.db"
+DB_FILE = db.DB_FILE
 RARE_THRESHOLD = 11
-CHUNK_SIZE = 65536  # 64KB chunks for reading compressed file
+HOLDING_COUNT = re.compile(rb'"totalHoldingCount"\s*:\s*(\d+)')  # Cheap pre-filter on the raw line
 
 # Function to normalize OCLC numbers by stripping leading zeros
 def normalize_oclc(oclc):
@@ -25,88 +30,87 @@ def setup_database():
     """
     Create database and necessary tables if they don't already exist.
     """
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS oclc_holdings (
-            oclc_number TEXT PRIMARY KEY,
-            total_holding_count INTEGER, 
-            isbn_13 INTEGER, 
-            title TEXT
-        )
-    """)
-    
-    conn.commit()
+    conn = db.connect(DB_FILE)
+    db.setup_schema(conn)
     conn.close()
     logging.info("Database setup complete.")
 
-def insert_oclc_record(cursor, oclc_number, total_holding_count):
+def parse_rare(line):
+    """
+    Return (record, oclc_number, total_holding_count) if the line is a rare record, else None.
+    The holding count is matched on the raw bytes first, so only rare records are parsed as JSON, once.
+    """
+    match = HOLDING_COUNT.search(line)
+    if not match or not RARE_THRESHOLD > int(match.group(1)) > 0:
+        return None
+    try:
+        record = json.loads(line)
+    except json.JSONDecodeError:
+        logging.warning("Skipping invalid JSON line.")
+        return None
+    metadata = record.get("metadata", {})
+    record_data = metadata.get("record", {})
+
+    oclc_number = normalize_oclc(metadata.get("oclc_number") or record_data.get("oclcNumber"))
+    total_holding_count = record_data.get("totalHoldingCount", 0)
+    if RARE_THRESHOLD > total_holding_count > 0 and oclc_number:
+        logging.debug(f"Found OCLC {oclc_number} with {total_holding_count} holdings.")
+        return record, oclc_number, total_holding_count
+    return None
+
+def rare_hit(line):
+    """Return (oclc_number, total_holding_count) if the line is a rare record, else None."""
+    parsed = parse_rare(line)
+    if parsed is None:
+        return None
+    return parsed[1:]
+
+def rare_record(line):
     """
-    Insert a new OCLC record into the database or update if exists.
+    Like rare_hit, but also amend the ISBN and title from the same parsed record, as
+    (oclc_number, total_holding_count, isbn_13, title); isbn_13 is None when the record has no valid ISBN.
     """
-    cursor.execute("""
-        INSERT OR REPLACE INTO oclc_holdings (oclc_number, total_holding_count)
-        VALUES (?, ?)
-    """, (oclc_number, total_holding_count))
+    parsed = parse_rare(line)
+    if parsed is None:
+        return None
+    record, oclc_number, total_holding_count = parsed
+    return (oclc_number, total_holding_count) + record_isbn(record)
 
-def extract_oclc_holdings(file_path, round_size=1000000, rounds = None):
+def extract_oclc_holdings(file_path, round_size=1000000, rounds = None, workers=None, amend=False):
     """
     Extract rare OCLC numbers and insert directly into the SQLite database.
+
+    The seekable .zst file is scanned in parallel by frame ranges (see
+    seekable_zst.scan_file) and results are written in file order by this
+    process, the only SQLite writer. With `rounds`, no new jobs are started
+    once `round_size * rounds` records have been processed. With `amend`,
+    the ISBN and title are filled in during the same pass, which makes the
+    separate amend_isbn pass unnecessary.
     """
     record_count = 0
-    round_counter = 0
+    hit_count = 0
+    max_records = round_size * rounds if rounds else None
 
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    conn = db.connect(DB_FILE)
 
     try:
-        with open(file_path, 'rb') as zst_file:
-            decompressor = zstd.ZstdDecompressor()
-            with decompressor.stream_reader(zst_file) as stream, tqdm(desc="Processing records", unit="line") as pbar:
-                buffer = b""
-
-                while True:
-                    chunk = stream.read(CHUNK_SIZE)
-                    if not chunk:
-                        break  # End of file reached
-
-                    buffer += chunk
-
-                    while b'\n' in buffer:
-                        line, buffer = buffer.split(b'\n', 1)
-                        if not line.strip():
-                            continue
-
-                        try:
-                            record = json.loads(line)
-                            metadata = record.get("metadata", {})
-                            record_data = metadata.get("record", {})
-
-                            oclc_number = normalize_oclc(metadata.get("oclc_number") or record_data.get("oclcNumber"))
-                            total_holding_count = record_data.get("totalHoldingCount", 0)
-
-                            if RARE_THRESHOLD > total_holding_count > 0 and oclc_number:
-                                insert_oclc_record(cursor, oclc_number, total_holding_count)
-                                logging.info(f"Found OCLC {oclc_number} with {total_holding_count} holdings.")
-
-                            record_count += 1
-                            pbar.update(1)
-
-                            if record_count % round_size == 0:
-                                round_counter += 1
-                                conn.commit()
-                                logging.info(f"Processed {record_count} records so far...")
-                                if rounds and round_counter >= rounds:
-                                    logging.info(f"Reached maximum rounds of {rounds}. Exiting.")
-                                    return 
-
-                        except json.JSONDecodeError:
-                            logging.warning("Skipping invalid JSON line.")
-                        except Exception as e:
-                            logging.error(f"Error processing line: {str(e)}")
-
-        conn.commit()
+        started = time.monotonic()
+        with db.bulk_load(conn), tqdm(desc="Processing records", unit="line") as pbar:
+            for hits, count in scan_file(file_path, rare_record if amend else rare_hit, workers, max_records=max_records):
+                if amend:
+                    db.upsert_amended(conn, hits)
+                else:
+                    db.upsert_holdings(conn, hits)
+                conn.commit()
+                record_count += count
+                hit_count += len(hits)
+                pbar.update(count)
+
+                elapsed = time.monotonic() - started
+                logging.info(f"Processed {record_count} records ({hit_count} rare), "
+                             f"{record_count / max(elapsed, 1e-9):,.0f} records/sec")
+        if max_records and record_count >= max_records:
+            logging.info(f"Reached maximum rounds of {rounds}. Exiting.")
 
     except FileNotFoundError:
         logging.error(f"File not found: {file_path}")
@@ -115,7 +119,7 @@ def extract_oclc_holdings(file_path, round_size=1000000, rounds = None):
     finally:
         conn.close()
 
-    logging.info(f"Processing complete. Total records processed: {record_count}")
+    logging.info(f"Processing complete. Total records processed: {record_count}, rare: {hit_count}")
 
 def main():
     input_filename = 'annas_archive_meta__aacid__worldcat__20241230T203056Z--20241230T203056Z.jsonl.seekable.zst'
@@ -125,7 +129,8 @@ def main():
     setup_database()
 
     logging.info("Starting extraction of OCLC holdings...")
-    extract_oclc_holdings(input_filename, round_size=round_size, rounds=1)
+    # --amend fills in ISBNs and titles in the same pass, replacing the amend_isbn.py step
+    extract_oclc_holdings(input_filename, round_size=round_size, rounds=1, amend="--amend" in sys.argv)
 
     logging.info("All records processed successfully.")
 
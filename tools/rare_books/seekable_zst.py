@@ -0,0 +1,190 @@
+"""
+Parallel line scanning of seekable zstd (.seekable.zst) files.
+
+A seekable zstd file is a sequence of independent frames followed by a seek
+table (a skippable frame listing the compressed and decompressed size of
+every frame), so any run of frames can be decompressed on its own. The file
+is split into jobs of whole frames. Each job yields its complete lines, plus
+the partial lines at both ends, so lines that straddle two jobs are stitched
+back together in order. `scan_file` runs the jobs on a process pool.
+"""
+import io
+import multiprocessing
+import os
+import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import zstandard as zstd
+
+SEEKABLE_MAGIC = 0x8F92EAB1
+SKIPPABLE_MAGIC = 0x184D2A5E
+FOOTER_SIZE = 9  # uint32 number of frames, uint8 descriptor, uint32 magic
+JOB_BYTES = 32 * 1024 * 1024  # Compressed bytes handed to a worker at a time
+CHUNK_SIZE = 1024 * 1024  # Decompressed bytes read at a time
+
+
+def read_seek_table(file_path):
+    """
+    Frame list of a seekable zstd file as (compressed offset, compressed size,
+    decompressed size) tuples, or None if the file has no seek table.
+    """
+    with open(file_path, "rb") as f:
+        file_size = f.seek(0, os.SEEK_END)
+        if file_size < FOOTER_SIZE:
+            return None
+        f.seek(file_size - FOOTER_SIZE)
+        n_frames, descriptor, magic = struct.unpack("<IBI", f.read(FOOTER_SIZE))
+        if magic != SEEKABLE_MAGIC:
+            return None
+        entry_size = 12 if descriptor & 0x80 else 8  # Entries carry a checksum when bit 7 is set
+        table_size = n_frames * entry_size
+        f.seek(file_size - FOOTER_SIZE - table_size - 8)
+        skippable_magic, frame_size = struct.unpack("<II", f.read(8))
+        if skippable_magic != SKIPPABLE_MAGIC or frame_size != table_size + FOOTER_SIZE:
+            raise ValueError(f"Corrupt seek table in {file_path}")
+        table = f.read(table_size)
+
+    frames = []
+    offset = 0
+    for k in range(n_frames):
+        compressed, decompressed = struct.unpack_from("<II", table, k * entry_size)
+        frames.append((offset, compressed, decompressed))
+        offset += compressed
+    return frames
+
+
+def frame_jobs(file_path, job_bytes=JOB_BYTES):
+    """
+    Split the file into (offset, size) byte ranges of whole frames, about
+    `job_bytes` compressed bytes each. A file without a seek table is one job.
+    """
+    frames = read_seek_table(file_path)
+    if frames is None:
+        return [(0, os.path.getsize(file_path))]
+    jobs = []
+    start = size = 0
+    for offset, compressed, _ in frames:
+        if size and size + compressed > job_bytes:
+            jobs.append((start, size))
+            start, size = offset, 0
+        size += compressed
+    if size:
+        jobs.append((start, size))
+    return jobs
+
+
+class RangeLines:
+    """
+    Iterate over the complete lines of the frames in [offset, offset + size).
+
+    The bytes before the first newline are kept in `head` and the bytes after
+    the last newline in `tail` instead of being yielded, since they may belong
+    to lines started or finished in the neighbouring jobs. If the range holds
+    no newline at all, everything is in `head` and `tail` is None.
+    """
+
+    def __init__(self, file_path, offset, size, chunk_size=CHUNK_SIZE):
+        self.file_path = file_path
+        self.offset = offset
+        self.size = size
+        self.chunk_size = chunk_size
+        self.head = b""
+        self.tail = None
+
+    def __iter__(self):
+        with open(self.file_path, "rb") as f:
+            f.seek(self.offset)
+            compressed = f.read(self.size)
+        reader = zstd.ZstdDecompressor().stream_reader(io.BytesIO(compressed), read_across_frames=True)
+        pending = b""
+        with reader:
+            while True:
+                chunk = reader.read(self.chunk_size)
+                if not chunk:
+                    break
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()
+                if not lines:
+                    continue
+                if self.tail is None:
+                    # First newline of the range: what precedes it is the head
+                    self.head, self.tail = lines[0], b""
+                    lines = lines[1:]
+                yield from lines
+        if self.tail is None:
+            self.head = pending
+        else:
+            self.tail = pending
+
+
+def stitch(carry, lines):
+    """
+    Join the tail carried over from the previous job with the head of the
+    RangeLines `lines`. Returns the completed line (or None) and the new carry.
+    """
+    if lines.tail is None:
+        return None, carry + lines.head
+    return carry + lines.head, lines.tail
+
+
+def _scan_job(file_path, offset, size, scan_line):
+    """Worker: apply `scan_line` to every non-empty line of one job, keeping its non-None results."""
+    lines = RangeLines(file_path, offset, size)
+    hits = []
+    record_count = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        record_count += 1
+        hit = scan_line(line)
+        if hit is not None:
+            hits.append(hit)
+    return lines, hits, record_count
+
+
+def scan_file(file_path, scan_line, workers=None, initializer=None, initargs=(), max_records=None):
+    """
+    Apply `scan_line` (a picklable, module-level function of one line) to
+    every line of the file on a pool of `workers` processes. Yields
+    (hits, record_count) per job in file order, where hits are the non-None
+    results in line order; consuming them in the calling process keeps it
+    the only writer. Workers are forked, so state the calling process loaded
+    before the call (e.g. a lookup set) is shared with them copy-on-write
+    instead of being loaded per worker. `initializer(*initargs)` runs in
+    every worker and in the calling process, which scans the lines stitched
+    across jobs. With `max_records`, no new job is started once that many
+    lines have been scanned.
+    """
+    workers = workers or os.cpu_count()
+    if initializer:
+        initializer(*initargs)
+    jobs = iter(frame_jobs(file_path))
+    record_total = 0
+    carry = b""
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                             initializer=initializer, initargs=initargs) as pool:
+        # Keep a bounded window of jobs in flight and collect them in file order
+        in_flight = deque(pool.submit(_scan_job, file_path, *job, scan_line) for job in islice(jobs, 2 * workers))
+        while in_flight:
+            lines, hits, record_count = in_flight.popleft().result()
+            line, carry = stitch(carry, lines)
+            if line and line.strip():
+                record_count += 1
+                hit = scan_line(line)
+                if hit is not None:
+                    hits.insert(0, hit)  # The stitched line precedes the job's own lines
+            yield hits, record_count
+            record_total += record_count
+            if max_records and record_total >= max_records:
+                for future in in_flight:
+                    future.cancel()
+                return
+            for job in islice(jobs, 1):
+                in_flight.append(pool.submit(_scan_job, file_path, *job, scan_line))
+
+    # The file may not end with a newline
+    if carry.strip():
+        hit = scan_line(carry)
+        yield [hit] if hit is not None else [], 1
@@ -2,12 +2,19 @@ import sqlite3
 import json
 import logging
 import math
+import struct
+import sys
 from pathlib import Path
-from PIL import Image
 import numpy as np
 
-DB_FILE = "rare_books.db"
+import db
+
+DB_FILE = db.DB_FILE
 OUTPUT_DIR = "tiles"
+RAREBOOK_TILES_DIR = "../../rarebook_tiles"
+TOOLS_DIR = Path(__file__).resolve().parent.parent
+ISBN_CODES_FILE = "../../aa_isbn13_codes_20241204T185335Z.benc.zst"
+ISBN_STORE_DIR = "../../isbn_store"
 BATCH_SIZE = 10000  # Process batch of records at a time
 BASE_ISBN = 978000000000  # 12-digit base ISBN on map
 TOTAL_WIDTH = 50000
@@ -15,6 +22,7 @@ TOTAL_HEIGHT = 40000
 TILE_WIDTH = 1000
 TILE_HEIGHT = 800
 RARE_THRESHOLD = 4
+TILE_MAGIC = b"RBT1"  # Binary rare-book tile, format version 1
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -35,111 +43,205 @@ def calculate_tile_position(isbn_13):
 
     return tile_x, tile_y
 
+def encode_tile(records, tile_x, tile_y):
+    """
+    Encode tile records ({"i", "t", "h", "e"}) in the binary columnar format,
+    all little-endian:
+
+        header   magic "RBT1", uint32 count, uint32 title bytes, uint16 tile_x, uint16 tile_y
+        uint64   ISBN-13 deltas (the first one from 0)
+        uint32   title offsets (count + 1) into the title table
+        uint16   local x, then uint16 local y
+        uint8    holdings, then uint8 existence
+        utf-8    title table
+
+    Records are sorted by local (y, x), which is ISBN order, so a viewport is
+    a range scan over rows.
+    """
+    records = sorted(records, key=lambda record: record["i"])
+    isbns = np.array([record["i"] for record in records], dtype="<u8")
+    titles = [(record.get("t") or "").encode("utf-8") for record in records]
+    offsets = np.zeros(len(records) + 1, dtype="<u4")
+    np.cumsum([len(title) for title in titles], out=offsets[1:])
+    offset = isbns // 10 - BASE_ISBN
+
+    return b"".join([
+        TILE_MAGIC,
+        struct.pack("<IIHH", len(records), int(offsets[-1]), tile_x, tile_y),
+        np.diff(isbns, prepend=np.uint64(0)).astype("<u8").tobytes(),
+        offsets.tobytes(),
+        (offset % TOTAL_WIDTH - tile_x * TILE_WIDTH).astype("<u2").tobytes(),
+        (offset // TOTAL_WIDTH - tile_y * TILE_HEIGHT).astype("<u2").tobytes(),
+        np.array([record["h"] for record in records], dtype=np.uint8).tobytes(),
+        np.array([record.get("e", 0) for record in records], dtype=np.uint8).tobytes(),
+        b"".join(titles),
+    ])
+
+
+def decode_tile(data):
+    """Decode a binary tile back into records ({"i", "t", "h", "e", "x", "y"}, x/y local)."""
+    if data[:4] != TILE_MAGIC:
+        raise ValueError("Not a binary rare-book tile")
+    count, title_bytes, _, _ = struct.unpack_from("<IIHH", data, 4)
+    position = 16
+    columns = {}
+    for name, dtype, length in (("i", "<u8", count), ("o", "<u4", count + 1), ("x", "<u2", count),
+                                ("y", "<u2", count), ("h", "u1", count), ("e", "u1", count)):
+        columns[name] = np.frombuffer(data, dtype=dtype, count=length, offset=position)
+        position += columns[name].nbytes
+    titles = data[position:position + title_bytes]
+    isbns = np.cumsum(columns["i"], dtype=np.uint64).tolist()
+    offsets = columns["o"].tolist()
+    return [
+        {"i": isbns[k], "t": titles[offsets[k]:offsets[k + 1]].decode("utf-8"), "h": h, "e": e, "x": x, "y": y}
+        for k, (h, e, x, y) in enumerate(zip(columns["h"].tolist(), columns["e"].tolist(),
+                                             columns["x"].tolist(), columns["y"].tolist()))
+    ]
+
+
+def write_binary_tile(tile_file, records, tile_x, tile_y):
+    """Write the binary twin (`.bin`) of a JSON tile file."""
+    tile_file.with_suffix(".bin").write_bytes(encode_tile(records, tile_x, tile_y))
+
+
+def convert_json_tiles(directory=OUTPUT_DIR):
+    """Produce the binary twin of every tile_X_Y.json in `directory`; the JSON stays for old clients."""
+    for tile_file in sorted(Path(directory).glob("tile_*_*.json")):
+        tile_x, tile_y = (int(part) for part in tile_file.stem.split("_")[1:])
+        with tile_file.open("r") as f:
+            records = json.load(f)
+        write_binary_tile(tile_file, records, tile_x, tile_y)
+        logging.info(f"Converted {len(records)} records of {tile_file.name}")
+
+
+def write_tile(tile_x, tile_y, records, directory=OUTPUT_DIR):
+    """Write one tile (JSON and its binary twin) atomically, replacing any previous version."""
+    tile_file = Path(directory) / f"tile_{tile_x}_{tile_y}.json"
+    tmp_file = tile_file.with_name(tile_file.name + ".tmp")
+    tmp_file.write_text(json.dumps(records, separators=(",", ":")))
+    tmp_file.replace(tile_file)
+    tmp_file = tile_file.with_name(tile_file.stem + ".bin.tmp")
+    tmp_file.write_bytes(encode_tile(records, tile_x, tile_y))
+    tmp_file.replace(tile_file.with_suffix(".bin"))
+
+
 def fetch_isbns_in_batches():
     """
-    Fetch ISBN records progressively in ascending order and process them in batches.
+    Stream the rare ISBN records in ascending order and write every tile exactly once.
+
+    Rows are paged by keyset on (isbn_13, oclc_number) rather than OFFSET, so
+    each batch is an index seek. ISBN order walks the map row by row, so all
+    tiles of one band of TILE_HEIGHT rows are complete as soon as a record of
+    a later band shows up; only that band (at most 50 tiles) is held in memory.
+    Tiles without records are written empty so the frontend never misses one.
     """
-    conn = sqlite3.connect(DB_FILE, timeout=10)  # Set timeout to avoid locking issues
+    conn = db.connect(DB_FILE)
     cursor = conn.cursor()
-    offset = 0
+    last_key = (-1, "")
+    tiles_x, tiles_y = TOTAL_WIDTH // TILE_WIDTH, TOTAL_HEIGHT // TILE_HEIGHT
+    band_y, band = 0, {}
+    written = 0
 
     Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
 
+    def flush_band(up_to):
+        # Write every tile of the finished bands [band_y, up_to), empty ones included
+        nonlocal band_y, band, written
+        for tile_y in range(band_y, up_to):
+            for tile_x in range(tiles_x):
+                records = band.pop((tile_x, tile_y), [])
+                write_tile(tile_x, tile_y, records, OUTPUT_DIR)
+                written += len(records)
+            logging.info(f"Band {tile_y} written, {written} records so far")
+        band_y = up_to
+
     try:
         while True:
-            logging.info(f"Fetching batch from offset {offset}...")
-
             cursor.execute("""
-                SELECT isbn_13, title, total_holding_count
+                SELECT isbn_13, oclc_number, title, total_holding_count
                 FROM oclc_holdings
                 WHERE isbn_13 IS NOT NULL AND
-                total_holding_count < ?
-                ORDER BY isbn_13 ASC
-                LIMIT ? OFFSET ?
-            """, (RARE_THRESHOLD, BATCH_SIZE, offset))
+                total_holding_count < ? AND
+                (isbn_13, oclc_number) > (?, ?)
+                ORDER BY isbn_13 ASC, oclc_number ASC
+                LIMIT ?
+            """, (RARE_THRESHOLD, *last_key, BATCH_SIZE))
 
             rows = cursor.fetchall()
             if not rows:
                 break  # No more records to process
+            last_key = rows[-1][:2]
 
-            # Process and write each record to the respective tile file
-            tile_data = {}
-            for isbn, title, holdings in rows:
+            for isbn, _, title, holdings in rows:
                 try:
                     tile_x, tile_y = calculate_tile_position(isbn)
-
-                    tile_key = f"tile_{tile_x}_{tile_y}"
-                    if tile_key not in tile_data:
-                        tile_data[tile_key] = []
-
-                    tile_data[tile_key].append({
-                        "i": isbn,  # Keep as integer
-                        "t": title,  # Title
-                        "h": holdings  # Holdings count
-                    })
-
                 except ValueError as e:
                     logging.error(f"Error processing ISBN {isbn}: {e}")
-
-            # Write collected tile data incrementally
-            for tile_key, records in tile_data.items():
-                tile_file = Path(OUTPUT_DIR) / f"{tile_key}.json"
-                if tile_file.exists():
-                    with tile_file.open("r+") as f:
-                        existing_data = json.load(f)
-                        existing_data.extend(records)
-                        f.seek(0)
-                        json.dump(existing_data, f, indent=2)
-                else:
-                    with tile_file.open("w") as f:
-                        json.dump(records, f, indent=2)
-
-                logging.info(f"Updated {len(records)} records in {tile_key}.json")
-
-            offset += BATCH_SIZE  # Move to the next batch
+                    continue
+                if tile_y >= tiles_y:
+                    logging.error(f"ISBN {isbn} is outside of the map")
+                    continue
+                if tile_y > band_y:
+                    flush_band(tile_y)
+                band.setdefault((tile_x, tile_y), []).append({
+                    "i": isbn,  # Keep as integer
+                    "t": title,  # Title
+                    "h": holdings  # Holdings count
+                })
+
+        flush_band(tiles_y)
 
     except sqlite3.OperationalError as e:
         logging.error(f"Database error: {e}")
     finally:
         conn.close()
 
-    logging.info("Processing complete.")
+    logging.info(f"Processing complete: {written} records written.")
+
+def load_md5_manager():
+    """BitmapManager of the md5 dataset, from the shared ISBN store of the map tools."""
+    sys.path.insert(0, str(TOOLS_DIR))
+    import data_loader as D
+    return D.load_bitmap_manager(ISBN_CODES_FILE, BASE_ISBN, "md5", store_dir=ISBN_STORE_DIR)
+
 
 # read the rare book json files from another folder with exact tile names, and evalute the records in those files
-# in the format of {"i", "t", "h"} and add "e"(existence) to the record based on the tile image here,
-# if the same isbn exists(green) in the tile image, then add "e": 1, otherwise "e": 0, and save the record
-def existence_check():
-    for i in range(50):
-        # if i != 0: continue    # just test one file
-        for j in range(50):
-            # if j != 0: continue    # just test one file
-            rarebook_tile_path = Path(f"../../rarebook_tiles/tile_{i}_{j}.json")
+# in the format of {"i", "t", "h"} and add "e"(existence) to the record: 1 if the ISBN is in the md5 dataset,
+# otherwise 0. All ISBNs are tested in one batch against the run-length index, and only tiles whose flags changed
+# are rewritten.
+def existence_check(directory=RAREBOOK_TILES_DIR):
+    md5 = load_md5_manager()
+    tiles = {}
+    for i in range(TOTAL_WIDTH // TILE_WIDTH):
+        for j in range(TOTAL_HEIGHT // TILE_HEIGHT):
+            rarebook_tile_path = Path(directory) / f"tile_{i}_{j}.json"
             if rarebook_tile_path.exists():
                 with rarebook_tile_path.open("r") as f:
-                    tile_data = json.load(f)
-                tile_path = Path(f"../../tiles/tile_{i}_{j}.png")
-                if tile_path.exists():
-                    img = Image.open(tile_path)
-                    img_data = np.array(img)
-                    for record in tile_data:
-                        isbn_index = record["i"] // 10 - BASE_ISBN
-                        global_row = isbn_index // TOTAL_WIDTH
-                        global_col = isbn_index % TOTAL_WIDTH
-                        local_row = global_row - j * TILE_HEIGHT
-                        local_col = global_col - i * TILE_WIDTH
-                        if img_data[local_row, local_col][1] == 255:
-                            record["e"] = 1
-                        else:
-                            record["e"] = 0
-                    with rarebook_tile_path.open("w") as f:
-                        json.dump(tile_data, f, indent=2)
-                    logging.info(f"Tile {i}, {j} done")
-            else: 
-                #create an empty tile file
-                with rarebook_tile_path.open("w") as f:
-                    json.dump([], f, indent=2)
+                    tiles[i, j] = json.load(f)
+            else:
+                # create an empty tile file
+                write_tile(i, j, [], directory)
+
+    isbns = np.array([record["i"] for records in tiles.values() for record in records], dtype=np.int64)
+    flags = md5.is_available_many(isbns).astype(np.uint8).tolist()
+    logging.info(f"Checked {len(isbns)} rare books against md5, {sum(flags)} exist")
+
+    first = 0
+    for (i, j), tile_data in tiles.items():
+        tile_flags = flags[first:first + len(tile_data)]
+        first += len(tile_data)
+        changed = [record.get("e") for record in tile_data] != tile_flags
+        if changed or not (Path(directory) / f"tile_{i}_{j}.bin").exists():
+            for record, flag in zip(tile_data, tile_flags):
+                record["e"] = flag
+            write_tile(i, j, tile_data, directory)
+            logging.info(f"Tile {i}, {j} updated")
 
 
 if __name__ == "__main__":
-    #fetch_isbns_in_batches()
-    existence_check()
\ No newline at end of file
+    if "--convert-json" in sys.argv:
+        # Only produce the binary twins of existing JSON tiles
+        convert_json_tiles(sys.argv[-1] if len(sys.argv) > 2 else OUTPUT_DIR)
+    else:
+        #fetch_isbns_in_batches()
+        existence_check()
\ No newline at end of file
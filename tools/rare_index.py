@@ -0,0 +1,180 @@
+"""
+In-memory spatial index of the rare books for viewport queries, and title
+search over the full-text index of rare_books.db.
+
+All rare books are held in parallel NumPy columns sorted by map position
+(`isbn12 - 978000000000`, laid out GRID_WIDTH per row). A rectangle is one
+contiguous position range per row, so a query is two `searchsorted` calls
+over its rows and costs O(rows * log n + books inside), whatever the density
+of the surrounding tiles.
+"""
+import json
+import os
+import re
+import sqlite3
+import struct
+from pathlib import Path
+
+import numpy as np
+
+START_ISBN = 978000000000
+GRID_WIDTH = 50000
+GRID_HEIGHT = 40000
+RARE_THRESHOLD = 4
+TILE_MAGIC = b"RBT1"
+SEARCH_TABLE = "titles_fts"  # Built by rare_books/db.build_search_index
+
+
+def read_binary_tile(data):
+    """Columns (isbns, holdings, existence, titles) of a binary tile, see rare_books/sort_tile.encode_tile."""
+    count, title_bytes, _, _ = struct.unpack_from("<IIHH", data, 4)
+    offset = 16
+    isbns = np.cumsum(np.frombuffer(data, "<u8", count, offset), dtype=np.uint64).astype(np.int64)
+    offset += 8 * count
+    title_offsets = np.frombuffer(data, "<u4", count + 1, offset).tolist()
+    offset += 4 * (count + 1) + 4 * count  # Skip the local x/y columns, positions come from the ISBNs
+    holdings = np.frombuffer(data, "u1", count, offset)
+    existence = np.frombuffer(data, "u1", count, offset + count)
+    table = data[offset + 2 * count:offset + 2 * count + title_bytes]
+    titles = [table[title_offsets[k]:title_offsets[k + 1]].decode("utf-8") for k in range(count)]
+    return isbns, holdings, existence, titles
+
+
+class RarebookIndex:
+    """Rare books as columns sorted by map position."""
+
+    def __init__(self, isbns, holdings, existence, titles):
+        isbns = np.asarray(isbns, dtype=np.int64)
+        order = np.argsort(isbns, kind="stable")
+        self.isbns = isbns[order]
+        self.positions = self.isbns // 10 - START_ISBN
+        self.holdings = np.asarray(holdings, dtype=np.uint8)[order]
+        self.existence = np.asarray(existence, dtype=np.uint8)[order]
+        self.titles = np.asarray(titles, dtype=object)[order]
+
+    def __len__(self):
+        return len(self.isbns)
+
+    @classmethod
+    def from_db(cls, db_file, threshold=RARE_THRESHOLD, existence=None):
+        """
+        Load the rare books (holdings below `threshold`) from rare_books.db.
+        `existence(isbns)` returns the `e` flags, e.g. md5 membership; 0 without it.
+        """
+        conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+        try:
+            rows = conn.execute("""
+                SELECT isbn_13, total_holding_count, title
+                FROM oclc_holdings
+                WHERE isbn_13 IS NOT NULL AND total_holding_count < ?
+            """, (threshold,)).fetchall()
+        finally:
+            conn.close()
+        isbns, holdings, titles = zip(*rows) if rows else ((), (), ())
+        isbns = np.array(isbns, dtype=np.int64)
+        flags = existence(isbns) if existence is not None else np.zeros(len(isbns), dtype=np.uint8)
+        return cls(isbns, holdings, flags, [title or "" for title in titles])
+
+    @classmethod
+    def from_tiles(cls, directory):
+        """Load every tile_X_Y.bin of `directory`, or tile_X_Y.json where no binary twin exists."""
+        isbns, holdings, existence, titles = [], [], [], []
+        for tile_file in sorted(Path(directory).glob("tile_*_*.json")):
+            binary = tile_file.with_suffix(".bin")
+            if binary.exists():
+                columns = read_binary_tile(binary.read_bytes())
+            else:
+                with tile_file.open("r") as f:
+                    records = json.load(f)
+                columns = ([r["i"] for r in records], [r["h"] for r in records],
+                           [r.get("e", 0) for r in records], [r.get("t") or "" for r in records])
+            for column, values in zip((isbns, holdings, existence, titles), columns):
+                column.extend(values.tolist() if isinstance(values, np.ndarray) else values)
+        return cls(isbns, holdings, existence, titles)
+
+    def query(self, x0, y0, x1, y1, max_holdings=None, limit=1000):
+        """
+        Books inside [x0, x1) x [y0, y1) (clipped to the grid) with at most
+        `max_holdings` holdings, rarest first, capped at `limit`. Returns the
+        selected row indices and the number of books that matched.
+        """
+        if limit <= 0:
+            raise ValueError(f"limit must be positive, got {limit}")
+        x0, x1 = max(x0, 0), min(x1, GRID_WIDTH)
+        y0, y1 = max(y0, 0), min(y1, GRID_HEIGHT)
+        if x1 <= x0 or y1 <= y0:
+            return np.zeros(0, dtype=np.int64), 0
+
+        row_starts = np.arange(y0, y1, dtype=np.int64) * GRID_WIDTH
+        first = np.searchsorted(self.positions, row_starts + x0, side="left")
+        last = np.searchsorted(self.positions, row_starts + x1, side="left")
+        lengths = last - first
+        # Concatenate the per-row ranges [first, last) into one index array
+        index = np.arange(lengths.sum()) + np.repeat(first - (np.cumsum(lengths) - lengths), lengths)
+        if max_holdings is not None:
+            index = index[self.holdings[index] <= max_holdings]
+
+        # The rows are already in position order; a stable (radix, for uint8) sort by holdings keeps it within ties
+        order = np.argsort(self.holdings[index], kind="stable")[:limit]
+        return index[order], len(index)
+
+    def records(self, index):
+        """Frontend records ({"i", "t", "h", "e", "x", "y"}, global x/y) of the given rows."""
+        positions = self.positions[index]
+        return [
+            {"i": i, "t": t, "h": h, "e": e, "x": x, "y": y}
+            for i, t, h, e, x, y in zip(self.isbns[index].tolist(), self.titles[index].tolist(),
+                                        self.holdings[index].tolist(), self.existence[index].tolist(),
+                                        (positions % GRID_WIDTH).tolist(), (positions // GRID_WIDTH).tolist())
+        ]
+
+
+def match_expression(query):
+    """FTS5 MATCH expression requiring every word of `query` as a prefix, e.g. 'vocab ital' -> '"vocab"* "ital"*'."""
+    words = re.findall(r"\w+", query)
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search_titles(db_file, query, min_holdings=None, max_holdings=None, limit=50, cursor=None):
+    """
+    Rare books with ISBNs whose title matches every word of `query` as a
+    prefix, in index order. `cursor` is the `next_cursor` of the previous
+    page. Returns (records {"i", "t", "h", "x", "y"}, next_cursor or None).
+    """
+    if limit <= 0:
+        raise ValueError(f"limit must be positive, got {limit}")  # rows[limit - 1] would be a wrong cursor
+    expression = match_expression(query)
+    if not expression:
+        return [], None
+    filters, params = "", [expression, cursor or 0]
+    if min_holdings is not None:
+        filters += " AND h.total_holding_count >= ?"
+        params.append(min_holdings)
+    if max_holdings is not None:
+        filters += " AND h.total_holding_count <= ?"
+        params.append(max_holdings)
+    conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    try:
+        rows = conn.execute(f"""
+            SELECT h.rowid, h.isbn_13, h.title, h.total_holding_count
+            FROM {SEARCH_TABLE} AS s JOIN oclc_holdings AS h ON h.rowid = s.rowid
+            WHERE {SEARCH_TABLE} MATCH ? AND s.rowid > ? AND h.isbn_13 IS NOT NULL{filters}
+            ORDER BY s.rowid
+            LIMIT ?
+        """, (*params, limit + 1)).fetchall()
+    finally:
+        conn.close()
+
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    records = []
+    for _, isbn, title, holdings in rows[:limit]:
+        position = isbn // 10 - START_ISBN
+        records.append({"i": isbn, "t": title, "h": holdings, "x": position % GRID_WIDTH, "y": position // GRID_WIDTH})
+    return records, next_cursor
+
+
+def load_rarebook_index(db_file, tiles_dir, existence=None):
+    """Index from rare_books.db when it exists, otherwise from the published tiles."""
+    if os.path.exists(db_file):
+        return RarebookIndex.from_db(db_file, existence=existence)
+    return RarebookIndex.from_tiles(tiles_dir)
@@ -0,0 +1,103 @@
+import numpy as np
+
+from isbn_runs import decode_runs, streak_bounds, union_bounds, occupancy
+
+GRID_WIDTH = 50000  # ISBN positions per row of the global map
+GRID_HEIGHT = 40000  # Rows of the global map at 1:1
+BAND_ROWS = 800  # Rows decoded at a time while filling a layer
+
+
+def rasterize_bounds(starts, ends, width=GRID_WIDTH, height=GRID_HEIGHT, band_rows=BAND_ROWS):
+    """
+    Fill a streak index into a bit-packed (height, ceil(width / 8)) layer.
+    Row `y`, column `x` holds the cell at position `y * width + x`.
+    """
+    layer = np.zeros((height, (width + 7) // 8), dtype=np.uint8)
+    for row in range(0, height, band_rows):
+        rows = min(band_rows, height - row)
+        # Nothing to fill if no streak overlaps this band
+        if np.searchsorted(ends, row * width, side="right") == np.searchsorted(starts, (row + rows) * width):
+            continue
+        band = occupancy(starts, ends, row * width, rows * width).reshape(rows, width)
+        layer[row:row + rows] = np.packbits(band, axis=1)
+    return layer
+
+
+def rasterize(packed_isbns_binary, width=GRID_WIDTH, height=GRID_HEIGHT):
+    """Decode one dataset's runs once into a bit-packed 1:1 occupancy layer."""
+    starts, ends = streak_bounds(decode_runs(packed_isbns_binary))
+    return rasterize_bounds(starts, ends, width, height)
+
+
+def rasterize_union(datasets, width=GRID_WIDTH, height=GRID_HEIGHT):
+    """1:1 occupancy layer of the union of several datasets' runs."""
+    starts, ends = union_bounds([streak_bounds(decode_runs(binary)) for binary in datasets])
+    return rasterize_bounds(starts, ends, width, height)
+
+
+def cut_tile(layer, tile_x, tile_y, tile_width=1000, tile_height=800):
+    """Slice one tile out of a bit-packed layer as a (tile_height, tile_width) bool array."""
+    col = tile_x * tile_width
+    row = tile_y * tile_height
+    tile = np.zeros((tile_height, tile_width), dtype=bool)
+    rows = layer[row:row + tile_height, col // 8:-(-(col + tile_width) // 8)]
+    if rows.size:
+        bits = np.unpackbits(rows, axis=1)[:, col % 8:col % 8 + tile_width]
+        tile[:bits.shape[0], :bits.shape[1]] = bits
+    return tile
+
+
+class TileRasterizer:
+    """
+    Renders map tiles from layers decoded once per scale: every dataset but
+    `highlight` is painted red, then `highlight` (md5) green on top. A pixel
+    of the 1:`scale` map covers a `scale` x `scale` block of the 1:1 map, as
+    the frontend zooms between the levels (see downscale_layer).
+    """
+
+    def __init__(self, isbn_data, highlight='md5'):
+        self.isbn_data = isbn_data
+        self.highlight = highlight
+        self._layers = {}
+
+    def layers(self, scale=1):
+        if scale not in self._layers:
+            if scale == 1:
+                others = [binary for prefix, binary in self.isbn_data.items() if prefix != self.highlight]
+                self._layers[1] = [
+                    (rasterize_union(others), [255, 0, 0]),
+                    (rasterize(self.isbn_data[self.highlight]), [0, 255, 0]),
+                ]
+            else:
+                self._layers[scale] = [(downscale_layer(layer, scale), color) for layer, color in self.layers(1)]
+        return self._layers[scale]
+
+    def render(self, tile_x=0, tile_y=0, tile_width=1000, tile_height=800, scale=1):
+        """RGB uint8 array for one tile of the 1:`scale` map."""
+        tile_data = np.zeros((tile_height, tile_width, 3), dtype=np.uint8)
+        for layer, color in self.layers(scale):
+            tile_data[cut_tile(layer, tile_x, tile_y, tile_width, tile_height)] = color
+        return tile_data
+
+
+def downscale_layer(layer, factor, width=GRID_WIDTH, band_rows=BAND_ROWS):
+    """
+    Block-downscale a bit-packed layer by `factor` in both directions, so it
+    lines up with the 1:1 map: a cell is set if any cell of its block is.
+    """
+    height = layer.shape[0]
+    out_width = -(-width // factor)
+    out = np.zeros((-(-height // factor), (out_width + 7) // 8), dtype=np.uint8)
+    band_rows -= band_rows % factor
+    for row in range(0, height, band_rows):
+        band = layer[row:row + band_rows]
+        rows = -(-band.shape[0] // factor)
+        # OR the rows of each block while still packed, then reduce the columns
+        packed = np.zeros((rows * factor, band.shape[1]), dtype=np.uint8)
+        packed[:band.shape[0]] = band
+        packed = np.bitwise_or.reduce(packed.reshape(rows, factor, -1), axis=1)
+        blocks = np.zeros((rows, out_width * factor), dtype=bool)
+        blocks[:, :width] = np.unpackbits(packed, axis=1, count=width)
+        blocks = blocks.reshape(rows, out_width, factor).any(axis=2)
+        out[row // factor:row // factor + rows] = np.packbits(blocks, axis=1)
+    return out
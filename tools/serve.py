@@ -0,0 +1,230 @@
+"""
+Pre-fork production server for app.py.
+
+The master loads the snapshot and builds every dataset's index once
+(app.init_data), then forks the workers. The run arrays are memory-mapped
+from the store and the indexes are NumPy arrays the workers only read, so
+their pages are shared copy-on-write instead of copied per worker; gc.freeze
+keeps the collector from writing to them. Each worker serves the listening
+socket it inherited with Werkzeug's threaded server.
+
+On SIGHUP, or when a newer snapshot file appears or the served one is
+rewritten, the master loads the new data, forks a new generation of workers
+on the same socket and sends the old ones SIGTERM: they stop accepting and
+finish the requests in flight. Loading reconverts the store whenever the
+file's size, mtime or content hash differ from its manifest
+(data_loader.store_is_current), and the store's files are replaced rather
+than rewritten, so the old generation keeps reading the old data while it
+drains. SIGTERM or SIGINT to the master stops all workers the same way.
+
+Usage (from the repository root, like app.py):
+    python tools/serve.py --workers 8 --port 5000
+    python tools/serve.py --input 'aa_isbn13_codes_*.benc.zst'   # serve the newest matching snapshot
+"""
+import argparse
+import gc
+import glob
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [TOOLS_DIR, os.path.dirname(TOOLS_DIR)]  # app.py imports both `tools.data_loader` and flat modules
+
+from werkzeug.serving import make_server
+
+import app as webapp
+import data_loader as D
+
+GRACEFUL_TIMEOUT = 30  # Seconds a stopping worker gets to finish its requests
+POLL_INTERVAL = 30  # Seconds between checks for a new snapshot; 0 disables them
+MASTER_SIGNALS = {signal.SIGHUP, signal.SIGTERM, signal.SIGINT}
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(process)d - %(levelname)s - %(message)s")
+
+
+def latest_snapshot(pattern):
+    """The newest file matching `pattern` (snapshot names sort by their timestamp), or `pattern` itself."""
+    matches = sorted(glob.glob(pattern))
+    return matches[-1] if matches else pattern
+
+
+def snapshot_signature(path):
+    """Cheap identity of a snapshot file for polling; load() then checks the content against the store."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return path, None
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+def run_worker(sock, graceful_timeout):
+    """Serve `sock` until SIGTERM, then finish the requests in flight. Never returns."""
+    status = 0
+    try:
+        server = make_server(*sock.getsockname()[:2], webapp.app, threaded=True, fd=sock.fileno())
+
+        def stop(signum, frame):
+            # shutdown() waits for serve_forever to return, so it cannot run in the serving thread
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the whole group; the master decides
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, MASTER_SIGNALS)
+        server.serve_forever()
+        deadline = time.monotonic() + graceful_timeout
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join(max(deadline - time.monotonic(), 0))
+        server.server_close()
+    except Exception:
+        logging.exception("Worker failed")
+        status = 1
+    finally:
+        os._exit(status)  # Skip the master's atexit handlers and buffered output
+
+
+class PreforkServer:
+    """Master process: owns the socket and the loaded snapshot, forks and replaces the workers."""
+
+    def __init__(self, sock, input_pattern, store_dir=D.STORE_DIR, workers=None,
+                 poll_interval=POLL_INTERVAL, graceful_timeout=GRACEFUL_TIMEOUT, preload_density=False):
+        self.sock = sock
+        self.input_pattern = input_pattern
+        self.store_dir = store_dir
+        self.n_workers = workers or os.cpu_count()
+        self.poll_interval = poll_interval
+        self.graceful_timeout = graceful_timeout
+        self.preload_density = preload_density
+        self.workers = {}  # pid -> generation
+        self.generation = 0
+        self.snapshot = None
+        self.reload_requested = False
+        self.stop_requested = False
+
+    def load(self):
+        """Load the newest snapshot and index every dataset, in this process only."""
+        path = latest_snapshot(self.input_pattern)
+        signature = snapshot_signature(path)
+        logging.info(f"Loading {path}...")
+        started = time.monotonic()
+        gc.unfreeze()
+        try:
+            registry = webapp.init_data(path, self.store_dir, preload=True)
+            webapp.get_rarebooks()
+            if self.preload_density:
+                # Built here, before forking, so no request ever waits for a pyramid
+                for name in registry.names:
+                    registry.density(name, build=True)
+        finally:
+            gc.collect()
+            gc.freeze()  # Objects alive now are never scanned again, so their pages stay shared after fork
+        self.snapshot = signature
+        self.generation += 1
+        logging.info(f"Generation {self.generation} loaded in {time.monotonic() - started:.1f}s")
+
+    def spawn(self):
+        # The child must not run the master's handlers before it installs its own
+        signal.pthread_sigmask(signal.SIG_BLOCK, MASTER_SIGNALS)
+        pid = os.fork()
+        if pid == 0:
+            run_worker(self.sock, self.graceful_timeout)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, MASTER_SIGNALS)
+        self.workers[pid] = self.generation
+
+    def stop_workers(self, generation=None):
+        """SIGTERM the workers of `generation` (all if None)."""
+        for pid, worker_generation in list(self.workers.items()):
+            if generation is None or worker_generation == generation:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    def reap(self):
+        """Collect exited workers and replace those of the current generation."""
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            generation = self.workers.pop(pid, None)
+            if generation == self.generation and not self.stop_requested:
+                logging.warning(f"Worker {pid} exited with status {status}, starting a new one")
+                self.spawn()
+
+    def reload(self):
+        old_generation = self.generation
+        try:
+            self.load()
+        except Exception as e:
+            logging.error(f"Reload failed, generation {old_generation} keeps serving: {e}")
+            return
+        for _ in range(self.n_workers):
+            self.spawn()
+        self.stop_workers(old_generation)
+        logging.info(f"Generation {self.generation} serving, generation {old_generation} draining")
+
+    def snapshot_changed(self):
+        return snapshot_signature(latest_snapshot(self.input_pattern)) != self.snapshot
+
+    def run(self):
+        self.load()
+        for _ in range(self.n_workers):
+            self.spawn()
+        host, port = self.sock.getsockname()[:2]
+        logging.info(f"Serving on http://{host}:{port} with {self.n_workers} workers")
+
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, "reload_requested", True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, "stop_requested", True))
+        signal.signal(signal.SIGINT, lambda signum, frame: setattr(self, "stop_requested", True))
+
+        next_poll = time.monotonic() + self.poll_interval
+        while not self.stop_requested:
+            if self.poll_interval and time.monotonic() >= next_poll:
+                next_poll = time.monotonic() + self.poll_interval
+                self.reload_requested |= self.snapshot_changed()
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.reap()
+            time.sleep(0.2)
+
+        logging.info("Stopping workers...")
+        self.stop_workers()
+        deadline = time.monotonic() + self.graceful_timeout + 1
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in self.workers:
+            os.kill(pid, signal.SIGKILL)
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve app.py with pre-forked workers sharing the loaded data.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--input", default=D.INPUT_FILENAME, help="snapshot .benc.zst file or glob; the newest match is served")
+    parser.add_argument("--store", default=D.STORE_DIR, help="directory of the memory-mapped ISBN store")
+    parser.add_argument("--poll", type=float, default=POLL_INTERVAL, help="seconds between snapshot checks, 0 to disable")
+    parser.add_argument("--graceful-timeout", type=float, default=GRACEFUL_TIMEOUT)
+    parser.add_argument("--backlog", type=int, default=1024)
+    parser.add_argument("--preload-density", action="store_true", help="build every missing density pyramid before forking")
+    args = parser.parse_args()
+
+    sock = socket.create_server((args.host, args.port), backlog=args.backlog)
+    PreforkServer(sock, args.input, args.store, args.workers, args.poll, args.graceful_timeout,
+                  args.preload_density).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Dataset statistics straight from the run arrays.
+
+Every figure is a vectorized sum over the streak index of a dataset, so a
+full pass over all datasets costs O(runs), not O(ISBNs): ISBN counts, the
+span from first to last ISBN, histograms of streak and gap lengths, counts
+per ISBN group prefix and per map tile. The union of all datasets ("all")
+is counted exactly from the merged streaks.
+
+Usage:
+    python stats.py                      # update ../static/data/all_books.json and tile_counts.json
+    python stats.py --summary stats.json # also dump the full statistics
+"""
+import argparse
+import json
+
+import numpy as np
+
+from density import bucket_counts
+from isbn_runs import decode_runs, streak_bounds, union_bounds
+
+START_ISBN = 978000000000
+GRID_WIDTH = 50000
+GRID_HEIGHT = 40000
+TILE_WIDTH = 1000
+TILE_HEIGHT = 800
+PREFIX_DIGITS = 2  # Group prefix digits after 978/979, e.g. "978-0" plus one more digit
+ALL_BOOKS_FILE = "../static/data/all_books.json"
+TILE_COUNTS_FILE = "../static/data/tile_counts.json"
+DATASETS_FILE = "./datasets.json"
+
+
+def length_histogram(lengths):
+    """Counts of lengths per power-of-two bucket: key k counts lengths in [2**k, 2**(k+1))."""
+    lengths = lengths[lengths > 0]
+    if len(lengths) == 0:
+        return {}
+    buckets = np.bincount(np.floor(np.log2(lengths)).astype(np.int64))
+    return {int(k): int(n) for k, n in enumerate(buckets) if n}
+
+
+def prefix_counts(starts, ends, digits=PREFIX_DIGITS, start_isbn=START_ISBN):
+    """ISBNs per group prefix of `digits` digits after the EAN prefix, e.g. {"978-01": 1234}."""
+    bucket = 10 ** (9 - digits)  # ISBN-12 digits left after 978/979 and the prefix digits
+    first = start_isbn // bucket
+    n_buckets = int(-(-int(ends[-1]) // bucket)) if len(ends) else 0
+    counts = bucket_counts(starts, ends, bucket, n_buckets)
+    return {
+        f"{(first + k) // 10 ** digits}-{(first + k) % 10 ** digits:0{digits}d}": int(n)
+        for k, n in enumerate(counts.tolist()) if n
+    }
+
+
+def tile_counts(starts, ends):
+    """ISBNs per map tile as a (rows, columns) array, from counts per tile-wide row segment."""
+    tiles_x, tiles_y = GRID_WIDTH // TILE_WIDTH, GRID_HEIGHT // TILE_HEIGHT
+    segments = bucket_counts(starts, ends, TILE_WIDTH, GRID_HEIGHT * tiles_x).astype(np.int64)
+    return segments.reshape(tiles_y, TILE_HEIGHT, tiles_x).sum(axis=1)
+
+
+def bounds_stats(starts, ends, start_isbn=START_ISBN):
+    """Statistics of one streak index (see module docstring)."""
+    lengths = ends - starts
+    return {
+        "count": int(lengths.sum()),
+        "streaks": len(starts),
+        "first_isbn": int(start_isbn + starts[0]) if len(starts) else None,
+        "last_isbn": int(start_isbn + ends[-1] - 1) if len(ends) else None,
+        "span": int(ends[-1] - starts[0]) if len(starts) else 0,
+        "streak_histogram": length_histogram(lengths),
+        "gap_histogram": length_histogram(starts[1:] - ends[:-1]),
+        "prefixes": prefix_counts(starts, ends, start_isbn=start_isbn),
+        "tiles": tile_counts(starts, ends),
+    }
+
+
+def compute_stats(isbn_data, start_isbn=START_ISBN):
+    """Statistics of every dataset plus their union under "all"."""
+    bounds = {name: streak_bounds(decode_runs(runs)) for name, runs in isbn_data.items()}
+    stats = {name: bounds_stats(*b, start_isbn) for name, b in sorted(bounds.items())}
+    stats["all"] = bounds_stats(*union_bounds(list(bounds.values())), start_isbn)
+    return stats
+
+
+def update_all_books(counts, all_books_file=ALL_BOOKS_FILE):
+    """Refresh the "count" of every entry of the frontend's all_books.json that has a known prefix."""
+    with open(all_books_file, "r") as f:
+        all_books = json.load(f)
+    for book in all_books:
+        if book["prefix"] in counts:
+            book["count"] = counts[book["prefix"]]
+    with open(all_books_file, "w") as f:
+        json.dump(all_books, f, indent=2)
+    print(f"{all_books_file} has been updated.")
+
+
+def write_tile_counts(stats, tile_counts_file=TILE_COUNTS_FILE):
+    """Per-tile ISBN counts for the frontend: {"datasets": {name: [[count per tile_x] per tile_y]}}."""
+    table = {
+        "tile_width": TILE_WIDTH,
+        "tile_height": TILE_HEIGHT,
+        "datasets": {name: s["tiles"].tolist() for name, s in stats.items()},
+    }
+    with open(tile_counts_file, "w") as f:
+        json.dump(table, f, separators=(",", ":"))
+    print(f"{tile_counts_file} has been updated.")
+
+
+def write_datasets(counts, datasets_file=DATASETS_FILE):
+    datasets = {name: count for name, count in counts.items() if name != "all"}
+    with open(datasets_file, "w") as f:
+        json.dump(datasets, f, indent=4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ISBN dataset statistics.")
+    parser.add_argument("--all-books", default=ALL_BOOKS_FILE)
+    parser.add_argument("--tile-counts", default=TILE_COUNTS_FILE)
+    parser.add_argument("--summary", help="write all statistics (without tile tables) to this JSON file")
+    args = parser.parse_args()
+
+    import data_loader as D
+    stats = compute_stats(D.load_isbn_data())
+    counts = {name: s["count"] for name, s in stats.items()}
+    for name, count in counts.items():
+        print(f"Total ISBNs for {name}: {count}")
+
+    write_datasets(counts)
+    update_all_books(counts, args.all_books)
+    write_tile_counts(stats, args.tile_counts)
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump({name: {k: v for k, v in s.items() if k != "tiles"} for name, s in stats.items()}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()